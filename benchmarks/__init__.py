@@ -0,0 +1 @@
+# Offline benchmarks for the tool; see run.py
@@ -0,0 +1,544 @@
+# Stand-ins for the NMTK server, the NMTK job helper and Rserve, so that
+# performModel can be run (and measured) on a machine with none of them.
+#
+#   FakeClient   records what an NMTKClient would have sent to the server: the
+#                status messages, and the result files (which are read through
+#                as an upload would, a block at a time).
+#   FakeJob      takes the place of NMTK_apps.helpers.confighelpers.Job, handing
+#                out parameters from a dictionary and features from CSV files
+#                (with their columns mapped to the tool's fields, as the job's
+#                configuration says).
+#   FakeRserve   takes the place of pyRserve, evaluating the R expressions that
+#                tasks.py and rpool.py send with Python emulations of the
+#                functions in R/configurator.R (rasterizing with rasterize.py and
+#                saving GeoTIFFs with geotiff.py).  It models the traffic to R
+#                (round trips, and an optional latency for each one), not the
+#                speed of R itself.
+#   FakeSignature, FakeChain and fakeChord stand in for Celery's canvas (when
+#                Celery isn't installed), running the tasks of a staged job one
+#                after another in this process, and recording the queue each
+#                was sent to in Routed.
+#
+# installFakes() puts these in place of the real modules, and loadTool()
+# imports the tool's modules with them.  NumPy is only imported by the fake R
+# functions that use it, as the tool itself only imports it when a job needs
+# it (see startup.py).
+
+import csv
+import imp
+import logging
+import os
+import re
+import sys
+import time
+import types
+import zlib
+import cStringIO as StringIO
+
+# The directory holding the tool (the parent of this one), and the package
+# name it is loaded under
+ToolDirectory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PackageName = "Configurator"
+
+class FakeClient(object):
+    '''
+    Records status updates and results instead of sending them to NMTK;
+    latency seconds are added to each call, to model a slow server
+    '''
+    BlockSize = 64*1024
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.statuses = []      # (time, message)
+        self.results = None     # keyword arguments of updateResults
+        self.uploaded = {}      # slug -> bytes "uploaded"
+        self.files = {}         # slug -> contents, for the small text files
+        self.failed = False
+
+    def updateStatus(self, message):
+        time.sleep(self.latency)
+        self.statuses.append((time.time(), message))
+
+    def updateResults(self, result_field=None, units=None, result_file=None,
+                      files=None, payload=None, failure=False):
+        time.sleep(self.latency)
+        self.results = { "result_field" : result_field, "units" : units,
+                         "result_file" : result_file, "payload" : payload }
+        self.failed = failure
+        for slug, (displayname, data, mimetype) in (files or {}).iteritems():
+            if hasattr(data, "read"):
+                size = 0
+                head = []
+                for block in iter(lambda: data.read(self.BlockSize), ""):
+                    size += len(block)
+                    if mimetype.startswith("text/") and size <= 1024*1024:
+                        head.append(block)
+                contents = "".join(head)
+            else:
+                size = len(data)
+                contents = data
+            self.uploaded[slug] = size
+            if mimetype.startswith("text/"):
+                self.files[slug] = contents
+
+class FakeFeatures(object):
+    '''
+    The features of a CSV input file: iterating gives a dictionary of the
+    tool's field name -> value for each row (fields maps the field names to
+    the file's columns; if it is empty, every column is given under its own
+    name; constants maps field names to the value given in every row), and
+    addResult adds a result field to the row most recently given
+    out.  As in NMTK, rows with results are held in memory until getDataFile
+    is called (rows that are only read are not kept).
+    '''
+    extension = "csv"
+    content_type = "text/csv"
+
+    def __init__(self, path, fields=None, constants=None):
+        self.path = path
+        self.fields = fields or {}
+        self.constants = constants or {}
+        self.rows = []
+        self.fieldnames = []
+        self._current = None
+
+    def __iter__(self):
+        with open(self.path, "rb") as f:
+            reader = csv.DictReader(f)
+            if not self.fieldnames:
+                self.fieldnames = list(reader.fieldnames)
+            for row in reader:
+                self._current = row
+                if self.fields:
+                    values = dict( (field, row.get(column)) for field, column in self.fields.iteritems() )
+                else:
+                    values = dict(row)
+                values.update(self.constants)
+                yield values
+        self._current = None
+
+    def addResult(self, name, value):
+        if name not in self.fieldnames:
+            self.fieldnames.append(name)
+        if self._current is not None:
+            self.rows.append(dict(self._current))
+            self._current = None
+        self.rows[-1][name] = value
+
+    def getDataFile(self):
+        output = StringIO.StringIO()
+        writer = csv.DictWriter(output, fieldnames=self.fieldnames, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(self.rows)
+        return output.getvalue()
+
+class FakeJob(object):
+    '''
+    Stands in for Config.Job.  input_files is a dictionary of namespace ->
+    path, and tool_config a dictionary of namespace -> dictionary of
+    parameters (as the NMTK job helper would present them)
+    '''
+    def __init__(self, input_files, tool_config):
+        self.input_files = input_files or {}
+        self.tool_config = tool_config or {}
+        self.failures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def setup(self):
+        pass
+
+    def getParameters(self, namespace):
+        return dict(self.tool_config.get(namespace, {}))
+
+    def datafile(self, namespace):
+        if namespace not in self.input_files:
+            raise KeyError("No file supplied for %s"%(namespace,))
+        return self.input_files[namespace]
+
+    def getFeatures(self, namespace):
+        # Properties are looked up in each row; other types are constants
+        fields = {}
+        constants = {}
+        for field, mapping in self.tool_config.get(namespace, {}).iteritems():
+            if not isinstance(mapping, dict):
+                fields[field] = mapping
+            elif mapping.get("type", "property") == "property":
+                fields[field] = mapping.get("value")
+            else:
+                constants[field] = mapping.get("value")
+        return FakeFeatures(self.datafile(namespace), fields, constants)
+
+    def fail(self, message):
+        self.failures.append(message)
+
+def toolModule(name):
+    # (the tool may not have imported it yet; see lazyimport.py)
+    return loadTool(name)
+
+def standInCompression(options):
+    '''
+    The geotiff.py compression standing in for GDAL's COMPRESS option (GDAL's
+    LZW, which is C code like zlib, is stood in for by DEFLATE, as geotiff.py
+    doesn't write LZW)
+    '''
+    compression = options.get("COMPRESS", "NONE")
+    return "DEFLATE" if compression == "LZW" else compression
+
+class RSession(object):
+    '''
+    The workspace of one emulated R session: variables, and the functions of
+    R/configurator.R (plus the few base functions the tool uses)
+    '''
+    def __init__(self):
+        self.variables = {}
+        self.version = None
+        self.functions = { "compute" : self.compute,
+                           "vectorfunc" : self.vectorfunc,
+                           "rasterizefunc" : self.rasterizefunc,
+                           "rasterizetiledfunc" : self.rasterizetiledfunc,
+                           "gridfunc" : self.gridfunc,
+                           "startfunc" : self.startfunc,
+                           "writefunc" : self.writefunc,
+                           "stopfunc" : self.stopfunc,
+                           "savefunc" : self.savefunc,
+                           "loadfunc" : self.loadfunc,
+                           "plotfunc" : self.plotfunc,
+                           "unlink" : self.unlink }
+
+    def compute(self, values, power):
+        import numpy
+        return numpy.power(numpy.asarray(values, dtype=numpy.float64), float(power))
+
+    def keep(self, name, obj, filename):
+        self.variables[name] = obj
+        self.variables[name + ".source"] = filename
+        return obj
+
+    def kept(self, name, filename):
+        return name in self.variables and self.variables.get(name + ".source") == filename
+
+    def vectorfunc(self, vectorfile, keepas=None):
+        if keepas and self.kept(keepas, vectorfile):
+            return self.variables[keepas]
+        obj = ("vector", toolModule("rasterize").readGeoJSON(vectorfile))
+        if keepas:
+            self.keep(keepas, obj, vectorfile)
+        return obj
+
+    def rasterizefunc(self, vectorfile, xdim, ydim, value):
+        features = self.vectorfunc(vectorfile, "input.file")[1]
+        rasterizer = toolModule("rasterize").Rasterizer(features, int(float(xdim)), int(float(ydim)), value)
+        return ("raster", rasterizer.burn(), rasterizer.extent)
+
+    def rasterizetiledfunc(self, vectorfile, xdim, ydim, value, filename, format, options="", windowrows=256):
+        features = self.vectorfunc(vectorfile, "input.file")[1]
+        rasterizer = toolModule("rasterize").Rasterizer(features, int(float(xdim)), int(float(ydim)), value)
+        out = self.startfunc(filename, format, options, rasterizer.extent, xdim, ydim)
+        for row0, block in rasterizer.windows(int(float(windowrows))):
+            out = self.writefunc(out, block.ravel(), row0 + 1)
+        return out
+
+    def startfunc(self, filename, format, options, bounds, xdim, ydim):
+        extent = tuple(bounds)
+        if format == "GTiff":
+            options = dict( option.split("=",1) for option in options.split(",") if "=" in option )
+            writer = toolModule("geotiff").GeoTIFFWriter(filename, int(float(xdim)), int(float(ydim)), extent,
+                                                          compression=standInCompression(options),
+                                                          tile_size=256 if options.get("TILED") == "YES" else None)
+        else:
+            writer = open(filename, "wb")
+        return ("writing", writer, extent, int(float(xdim)))
+
+    def writefunc(self, out, values, row):
+        import numpy
+        kind, writer, extent, xdim = out
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if isinstance(writer, file):
+            writer.write(values.tobytes())
+        else:
+            writer.write(values.reshape(-1, xdim))
+        return out
+
+    def stopfunc(self, out, filename, keepas=None):
+        # Like R's writeStop, the result refers to the file rather than
+        # holding the values
+        kind, writer, extent, xdim = out
+        writer.close()
+        obj = ("raster", filename, extent)
+        if keepas:
+            self.keep(keepas, obj, filename)
+        return obj
+
+    def gridfunc(self, values, bounds, xdim, ydim):
+        import numpy
+        grid = numpy.asarray(values, dtype=numpy.float64).reshape(int(ydim), int(xdim))
+        return ("raster", grid, tuple(bounds))
+
+    def savefunc(self, obj, filename, format, options="", keepas=None):
+        kind, grid, extent = obj
+        if keepas:
+            self.keep(keepas, obj, filename)
+        if format == "GTiff":
+            options = dict( option.split("=",1) for option in options.split(",") if "=" in option )
+            toolModule("geotiff").writeGeoTIFF(filename, grid, extent,
+                                               compression=standInCompression(options),
+                                               tile_size=256 if options.get("TILED") == "YES" else None)
+        else:
+            # Stands in for HFA and RDS: the same amount of data, uncompressed
+            with open(filename, "wb") as f:
+                f.write(grid.tobytes())
+        return 0
+
+    def loadfunc(self, filename, format, keepas=None):
+        import numpy
+        if keepas and self.kept(keepas, filename):
+            return self.variables[keepas]
+        if format == "GTiff":
+            grid, extent, nodata = toolModule("geotiff").readGeoTIFF(filename)
+            return ("raster", grid, extent)
+        with open(filename, "rb") as f:
+            return ("raster", numpy.frombuffer(f.read(), dtype=numpy.float64), None)
+
+    def plotfunc(self, obj, outfile, device):
+        # Write something of about the size a plot would be, having looked
+        # at all of the data
+        with open(outfile, "wb") as f:
+            f.write(zlib.compress(repr(obj[1])[:1024*1024]))
+        return 0
+
+    def unlink(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return 0
+
+    # A very small evaluator for the calls the tool makes: "name <- f(a, b)"
+    # or "f(a, b)" statements, where the arguments are variables, numbers,
+    # strings or nested calls.
+    Token = re.compile(r'\s*(?:(<-)|([A-Za-z_.][A-Za-z0-9_.]*)|(-?[0-9.]+(?:[eE][-+]?[0-9]+)?)|("[^"]*"|\'[^\']*\')|(.))')
+
+    def evaluate(self, source):
+        result = None
+        for statement in re.split(r'[;\n]', source):
+            if statement.strip():
+                result = self._statement(statement)
+        return result
+
+    def _statement(self, statement):
+        tokens = [ t for t in self.Token.findall(statement) if any(t) ]
+        target = None
+        if len(tokens) > 2 and tokens[1][0] == "<-":
+            target = tokens[0][1]
+            tokens = tokens[2:]
+        value, rest = self._expression(tokens)
+        if target:
+            self.variables[target] = value
+        return value
+
+    def _expression(self, tokens):
+        assign, name, number, string, other = tokens[0]
+        if number:
+            return float(number), tokens[1:]
+        if string:
+            return string[1:-1], tokens[1:]
+        if name and len(tokens) > 1 and tokens[1][4] == "(":
+            args = []
+            tokens = tokens[2:]
+            while tokens[0][4] != ")":
+                arg, tokens = self._expression(tokens)
+                args.append(arg)
+                if tokens[0][4] == ",":
+                    tokens = tokens[1:]
+            return self.functions[name](*args), tokens[1:]
+        if name:
+            return self.variables[name], tokens[1:]
+        raise ValueError("Can't evaluate %r"%(tokens,))
+
+class FakeNamespace(object):
+    '''
+    The conn.r of a FakeConnection: calling it evaluates R, setting an
+    attribute assigns an R variable, and getting one looks up a variable or
+    an emulated function
+    '''
+    def __init__(self, connection):
+        self.__dict__["_connection"] = connection
+
+    def __call__(self, source, void=False):
+        return self._connection.eval(source, void)
+
+    def __setattr__(self, name, value):
+        self._connection.trip()
+        self._connection.session.variables[name] = value
+
+    def __getattr__(self, name):
+        self._connection.trip()
+        session = self._connection.session
+        if name in session.functions:
+            function = session.functions[name]
+            def call(*args):
+                self._connection.trip()
+                return function(*args)
+            return call
+        return session.variables[name]
+
+class FakeConnection(object):
+    '''
+    A connection to an emulated Rserve session, with latency seconds added
+    to each round trip
+    '''
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.session = RSession()
+        self.isClosed = False
+        self.trips = 0
+        self.r = FakeNamespace(self)
+
+    def trip(self):
+        if self.isClosed:
+            raise EOFError("Connection closed")
+        self.trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def eval(self, source, void=False):
+        self.trip()
+        session = self.session
+        if "configurator.version" in source and "exists(" in source:
+            result = session.version or ""         # rpool's ping
+        elif "configurator_init" in source:
+            session.version = session.variables.pop("configurator_version", None)
+            session.variables.pop("configurator_init", None)
+            result = None
+        elif "rm(list=ls(" in source:
+            session.variables.clear()
+            result = None
+        else:
+            result = session.evaluate(source)
+        return None if void else result
+
+    def close(self):
+        self.isClosed = True
+
+class FakeRserve(object):
+    '''
+    Stands in for the pyRserve module
+    '''
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.connections = 0
+
+    def connect(self, **kwargs):
+        self.connections += 1
+        return FakeConnection(self.latency)
+
+# (task name, queue) of each task run through the fake canvas, in order
+Routed = []
+
+class FakeSignature(object):
+    '''
+    Stands in for a Celery signature: function, with arguments to follow
+    those passed on by the task before it (if any)
+    '''
+    def __init__(self, function, args, options=None):
+        self.function = function
+        self.args = tuple(args)
+        self.options = dict(options or {})
+
+    def set(self, **options):
+        self.options.update(options)
+        return self
+
+    def apply(self, passed=()):
+        Routed.append((self.function.__name__, self.options.get("queue")))
+        return self.function(*(tuple(passed) + self.args))
+
+    def apply_async(self):
+        return self.apply()
+
+class FakeChain(object):
+    '''
+    Stands in for a Celery chain: each task is passed the result of the one
+    before
+    '''
+    def __init__(self, *signatures):
+        self.signatures = signatures
+
+    def apply(self, passed=()):
+        for signature in self.signatures:
+            passed = ( signature.apply(passed), )
+        return passed[0]
+
+    def apply_async(self):
+        return self.apply()
+
+def fakeChord(header):
+    '''
+    Stands in for a Celery chord: calling it with the body runs the header
+    tasks, then the body with the list of their results
+    '''
+    def body(signature):
+        return signature.apply(( [ item.apply() for item in header ], ))
+    return body
+
+def installFakes(static_root, cache_dir, rserve_latency=0.0):
+    '''
+    Put the stand-ins in place of pyRserve and the NMTK job helper, and
+    provide minimal stand-ins for Celery and Django if they aren't installed.
+    Returns the FakeRserve.
+    '''
+    rserve = FakeRserve(rserve_latency)
+    module = types.ModuleType("pyRserve")
+    module.connect = rserve.connect
+    sys.modules["pyRserve"] = module
+
+    for name in ("NMTK_apps", "NMTK_apps.helpers", "NMTK_apps.helpers.confighelpers"):
+        sys.modules[name] = types.ModuleType(name)
+    sys.modules["NMTK_apps"].helpers = sys.modules["NMTK_apps.helpers"]
+    sys.modules["NMTK_apps.helpers"].confighelpers = sys.modules["NMTK_apps.helpers.confighelpers"]
+    sys.modules["NMTK_apps.helpers.confighelpers"].Job = FakeJob
+
+    try:
+        from django.conf import settings
+        if not settings.configured:
+            settings.configure()
+    except ImportError:
+        django = sys.modules["django"] = types.ModuleType("django")
+        django.conf = sys.modules["django.conf"] = types.ModuleType("django.conf")
+        settings = django.conf.settings = types.ModuleType("settings")
+        settings.configured = True
+    settings.STATIC_ROOT = static_root
+    settings.CONFIGURATOR_CACHE_DIR = cache_dir
+
+    try:
+        import celery.task
+    except ImportError:
+        def task(**options):
+            def decorate(function):
+                function.get_logger = lambda: logging.getLogger(PackageName + ".tasks")
+                function.s = lambda *args: FakeSignature(function, args)
+                function.apply_async = lambda args=(), **options: FakeSignature(function, args, options).apply()
+                return function
+            return decorate
+        celery = sys.modules["celery"] = types.ModuleType("celery")
+        celery.task = sys.modules["celery.task"] = types.ModuleType("celery.task")
+        celery.task.task = task
+        celery.chain = FakeChain
+        celery.chord = fakeChord
+    return rserve
+
+def loadTool(module="tasks"):
+    '''
+    Import one of the tool's modules (by default tasks, after installFakes)
+    '''
+    if PackageName not in sys.modules:
+        package = imp.new_module(PackageName)
+        package.__path__ = [ ToolDirectory ]
+        sys.modules[PackageName] = package
+    __import__(PackageName + "." + module)
+    return sys.modules[PackageName + "." + module]
@@ -0,0 +1,63 @@
+# Synthetic inputs for the benchmarks, generated at any scale:
+#
+#   writeCSV       a computation input of N rows by M "raiseme"-style fields
+#   writeGeoJSON   a rasterization input of K polygons (a jittered grid of
+#                  quadrilaterals, each with a numeric TAZ attribute)
+#
+# The same arguments (and seed) always give the same file, so results from
+# different runs can be compared.
+
+import csv
+import json
+import math
+import random
+
+def fieldNames(nfields):
+    '''
+    The names of the computation fields: raiseme, raiseme2, raiseme3, ...
+    (as in static/Configurator/Some_Numbers.csv)
+    '''
+    return [ "raiseme" ] + [ "raiseme%d"%(n,) for n in range(2, nfields+1) ]
+
+def writeCSV(path, nrows, nfields, seed=1):
+    '''
+    Write a CSV file with a Row column and nfields numeric fields
+    '''
+    generator = random.Random(seed)
+    names = fieldNames(nfields)
+    with open(path, "wb") as f:
+        writer = csv.writer(f)
+        writer.writerow([ "Row" ] + names)
+        for row in xrange(1, nrows+1):
+            writer.writerow([ row ] + [ "%.4f"%(generator.uniform(-100, 100),) for name in names ])
+
+def writeGeoJSON(path, npolygons, extent=(-77.09, -77.03, 38.78, 38.85), seed=1):
+    '''
+    Write a GeoJSON FeatureCollection of npolygons polygons covering extent
+    (xmin, xmax, ymin, ymax), in longitude/latitude like Vector_Test.geojson
+    '''
+    generator = random.Random(seed)
+    xmin, xmax, ymin, ymax = extent
+    across = int(math.ceil(math.sqrt(npolygons)))
+    down = int(math.ceil(npolygons / float(across)))
+    dx = (xmax - xmin) / across
+    dy = (ymax - ymin) / down
+
+    # Shared, jittered corners so that neighbouring polygons meet exactly
+    corners = {}
+    def corner(i, j):
+        if (i, j) not in corners:
+            jx = 0 if i in (0, across) else generator.uniform(-0.3, 0.3) * dx
+            jy = 0 if j in (0, down) else generator.uniform(-0.3, 0.3) * dy
+            corners[(i, j)] = [ xmin + i * dx + jx, ymax - j * dy + jy ]
+        return corners[(i, j)]
+
+    features = []
+    for number in range(npolygons):
+        i, j = number % across, number // across
+        ring = [ corner(i, j), corner(i+1, j), corner(i+1, j+1), corner(i, j+1), corner(i, j) ]
+        features.append({ "type" : "Feature",
+                          "properties" : { "TAZ" : number + 1 },
+                          "geometry" : { "type" : "Polygon", "coordinates" : [ ring ] } })
+    with open(path, "w") as f:
+        json.dump({ "type" : "FeatureCollection", "features" : features }, f)
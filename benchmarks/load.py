@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# Concurrent load test for performModel, for capacity planning.
+#
+# Fires a mix of jobs at a pool of N concurrent workers, using the stand-in
+# NMTK client, job helper and Rserve (see fakes.py), and reports for each
+# kind of job the throughput (jobs/sec), the latency percentiles (the time
+# from a job starting to its results being sent) and the error rate, along
+# with the peak memory of the largest worker process.  Trying increasing
+# levels of concurrency shows where throughput stops growing.
+#
+# The workers are either threads in this process or, like a Celery prefork
+# worker, separate processes (--executor process).  The stand-in Rserve runs
+# in the worker itself, so --rserve-latency is the way to model a busy or
+# distant Rserve.
+#
+#   python -m benchmarks.load --list
+#   python -m benchmarks.load --mix compute=2,raster-image=1,sample=1 \
+#                             --concurrency 1,2,4,8 --jobs 40 --executor process
+#
+# Identical jobs would normally be answered from the result cache, so the
+# caches are disabled unless --cache is given.
+
+import logging
+import multiprocessing
+import optparse
+import os
+import Queue
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from . import fakes
+from . import run
+
+# The kinds of job that can be mixed: benchmark scenarios (see run.py), or
+# None for the sample job from the tool configuration
+JobTypes = {
+    "compute" :      { "rows" : 10000, "fields" : 3, "compute" : "Both" },
+    "raster-image" : { "polygons" : 1000, "raster" : 300, "engine" : "R", "images" : 1 },
+    "sample" :       None,
+    }
+
+def sampleJob():
+    '''
+    The input_files and tool_config of the sample job in tool_configs.py,
+    with the defaults of the tool's input and output elements filled in (as
+    NMTK does when a job is submitted)
+    '''
+    tool_configs = fakes.loadTool("tool_configs")
+    config = tool_configs.tool_config
+    parameters = {}
+    for section in config.get("input", []) + config.get("output", []):
+        values = parameters.setdefault(section["namespace"], {})
+        for element in section.get("elements", []):
+            if "default" in element:
+                values[element["name"]] = element["default"]
+    for namespace, elements in config["sample"]["config"].iteritems():
+        for name, element in elements.iteritems():
+            parameters.setdefault(namespace, {})[name] = element["value"]
+    static = os.path.join(fakes.ToolDirectory, "static")
+    input_files = dict( (f["namespace"], os.path.join(static, f["uri"].split("/static/",1)[1]))
+                        for f in config["sample"]["files"] )
+    return input_files, parameters
+
+def prepareJobs(mix, workdir):
+    '''
+    Generate the inputs for each kind of job in mix, returning a dictionary
+    of job type -> (input_files, tool_config)
+    '''
+    jobs = {}
+    for jobtype in mix:
+        if JobTypes[jobtype] is None:
+            jobs[jobtype] = sampleJob()
+        else:
+            directory = os.path.join(workdir, jobtype)
+            os.makedirs(directory)
+            jobs[jobtype] = run.jobConfiguration(JobTypes[jobtype], directory)
+    return jobs
+
+def parseMix(text):
+    '''
+    Parse a mix such as "compute=2,sample=1" into a dictionary of job type ->
+    weight
+    '''
+    mix = {}
+    for part in text.split(","):
+        name, sep, weight = part.partition("=")
+        name = name.strip()
+        if name not in JobTypes:
+            raise ValueError("Unknown job type %s"%(name,))
+        mix[name] = float(weight) if sep else 1.0
+    return mix
+
+def jobSequence(mix, count, seed=1):
+    '''
+    A reproducible list of count job types drawn according to the weights
+    in mix
+    '''
+    generator = random.Random(seed)
+    names = sorted(mix)
+    total = sum(mix.values())
+    sequence = []
+    for n in range(count):
+        pick = generator.uniform(0, total)
+        for name in names:
+            pick -= mix[name]
+            if pick <= 0:
+                break
+        sequence.append(name)
+    return sequence
+
+def setupWorker(cache_dir, rserve_latency, cache):
+    '''
+    Put the stand-ins in place and load the tool (in each worker process, or
+    once for the thread executor)
+    '''
+    fakes.installFakes(os.path.join(fakes.ToolDirectory, "static"), cache_dir, rserve_latency)
+    tasks = fakes.loadTool()
+    if not cache:
+        tasks.ResultCacheBytes = 0
+        tasks.RasterCacheBytes = 0
+    logging.getLogger().setLevel(logging.WARNING)
+    return tasks
+
+def runJob(job):
+    '''
+    Run one job, returning (job type, latency in seconds, error or None)
+    '''
+    jobtype, input_files, tool_config, nmtk_latency = job
+    tasks = fakes.loadTool()
+    client = fakes.FakeClient(nmtk_latency)
+    start = time.time()
+    try:
+        tasks.performModel(input_files, tool_config, client)
+        error = None
+        if client.failed or client.results is None:
+            error = str((client.results or {}).get("payload"))
+    except Exception:
+        error = traceback.format_exc()
+    return jobtype, time.time() - start, error
+
+def initProcess(cache_dir, rserve_latency, cache):
+    setupWorker(cache_dir, rserve_latency, cache)
+
+def runThreads(jobs, concurrency):
+    pending = Queue.Queue()
+    for job in jobs:
+        pending.put(job)
+    results = []
+    lock = threading.Lock()
+    def worker():
+        while True:
+            try:
+                job = pending.get_nowait()
+            except Queue.Empty:
+                return
+            result = runJob(job)
+            with lock:
+                results.append(result)
+    threads = [ threading.Thread(target=worker) for n in range(concurrency) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def runProcesses(jobs, concurrency, cache_dir, rserve_latency, cache):
+    pool = multiprocessing.Pool(concurrency, initProcess, (cache_dir, rserve_latency, cache))
+    try:
+        return list(pool.imap_unordered(runJob, jobs))
+    finally:
+        pool.close()
+        pool.join()
+
+def percentile(values, fraction):
+    '''
+    The nearest-rank percentile of a list of values
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(-(-fraction * len(values) // 1)), 1)
+    return values[min(rank, len(values)) - 1]
+
+def summarise(results, elapsed):
+    '''
+    Throughput, latency percentiles and error rate for each job type (and
+    "all"), from a list of (job type, latency, error)
+    '''
+    groups = {}
+    for jobtype, latency, error in results:
+        for name in (jobtype, "all"):
+            groups.setdefault(name, []).append((latency, error))
+    summary = {}
+    for name, group in groups.iteritems():
+        latencies = [ latency for latency, error in group ]
+        errors = sum(1 for latency, error in group if error)
+        summary[name] = { "jobs" : len(group),
+                          "errors" : errors,
+                          "error_rate" : errors / float(len(group)),
+                          "jobs_per_s" : len(group) / elapsed if elapsed else None,
+                          "p50_s" : percentile(latencies, 0.50),
+                          "p95_s" : percentile(latencies, 0.95),
+                          "p99_s" : percentile(latencies, 0.99) }
+    return summary
+
+def peakMemory(executor):
+    '''
+    Peak RSS in kB of the largest process that ran jobs
+    '''
+    if not resource:
+        return None
+    who = resource.RUSAGE_CHILDREN if executor == "process" else resource.RUSAGE_SELF
+    return resource.getrusage(who).ru_maxrss
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--list", action="store_true", help="list the kinds of job")
+    parser.add_option("--mix", default="compute=1,raster-image=1,sample=1",
+                      help="job types and weights, e.g. compute=2,sample=1")
+    parser.add_option("--concurrency", default="1,2,4",
+                      help="comma-separated numbers of concurrent jobs to try")
+    parser.add_option("--jobs", type="int", default=0,
+                      help="jobs at each level of concurrency (default 5 per worker)")
+    parser.add_option("--executor", choices=("thread", "process"), default="process",
+                      help="run jobs in threads or processes (default process)")
+    parser.add_option("--rserve-latency", type="float", default=0.0,
+                      help="seconds added to each Rserve round trip")
+    parser.add_option("--nmtk-latency", type="float", default=0.0,
+                      help="seconds added to each call to the NMTK server")
+    parser.add_option("--cache", action="store_true", help="leave the result caches enabled")
+    options, args = parser.parse_args(argv)
+
+    if options.list:
+        for name in sorted(JobTypes):
+            print("%-14s %s"%(name, JobTypes[name] or "the sample job from tool_configs.py"))
+        return 0
+    try:
+        mix = parseMix(options.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    levels = [ int(level) for level in options.concurrency.split(",") ]
+
+    workdir = tempfile.mkdtemp(prefix="configurator-load-")
+    try:
+        setupWorker(os.path.join(workdir, "cache"), options.rserve_latency, options.cache)
+        prepared = prepareJobs(mix, workdir)
+        failed = False
+        for concurrency in levels:
+            count = options.jobs or 5 * concurrency
+            jobs = [ (jobtype,) + prepared[jobtype] + (options.nmtk_latency,)
+                     for jobtype in jobSequence(mix, count) ]
+            start = time.time()
+            if options.executor == "thread":
+                results = runThreads(jobs, concurrency)
+            else:
+                results = runProcesses(jobs, concurrency, os.path.join(workdir, "cache"),
+                                       options.rserve_latency, options.cache)
+            elapsed = time.time() - start
+            summary = summarise(results, elapsed)
+            print("Concurrency %d (%s): %d jobs in %.2f s, %.2f jobs/s, peak RSS %s kB"%(
+                concurrency, options.executor, len(results), elapsed,
+                summary["all"]["jobs_per_s"], peakMemory(options.executor)))
+            print("    %-14s %6s %7s %8s %8s %8s %8s"%("jobs", "count", "errors", "jobs/s",
+                                                      "p50 s", "p95 s", "p99 s"))
+            for name in sorted(summary, key=lambda n: (n == "all", n)):
+                s = summary[name]
+                print("    %-14s %6d %6.1f%% %8.2f %8.3f %8.3f %8.3f"%(name, s["jobs"], 100 * s["error_rate"],
+                                                                  s["jobs_per_s"], s["p50_s"],
+                                                                  s["p95_s"], s["p99_s"]))
+            for jobtype, latency, error in results:
+                if error:
+                    print("    error (%s): %s"%(jobtype, error.strip().splitlines()[-1] if error.strip() else error))
+                    failed = True
+                    break
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# Offline benchmarks for performModel.
+#
+# Each scenario generates its inputs (see inputs.py), then runs performModel
+# against the stand-in NMTK client, job helper and Rserve (see fakes.py) in a
+# fresh child process, so that its peak memory is its own and no cache or R
+# session carries over from an earlier run.  The stage measurements logged by
+# performModel (see instrument.py) are collected from each run and reported,
+# taking the median of the repeats.
+#
+# Run from the directory above the tool (or with it on PYTHONPATH):
+#
+#   python -m benchmarks.run --list
+#   python -m benchmarks.run [--repeat 3] [--large] [scenario ...]
+#   python -m benchmarks.run --save        # record the results as the baseline
+#   python -m benchmarks.run --compare     # fail if a stage has slowed down
+#
+# Baselines are machine-specific, so they're kept in a JSON file named after
+# the host (benchmarks/baselines/<host>.json by default).
+
+import json
+import logging
+import multiprocessing
+import optparse
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from . import fakes
+from . import inputs
+
+# A scenario is a dictionary of:
+#   rows, fields   size of the computation input (no computation if rows is 0)
+#   constants      number of further computation fields given constant
+#                  values rather than columns of the input
+#   compute        the computetype parameter
+#   polygons       size of the rasterization input (default vector if 0)
+#   raster         raster size in cells along each side (no rasterization if 0)
+#   engine         rasterengine parameter
+#   format         return_raster parameter
+#   overviews      raster_overviews parameter
+#   images         imagevector/imageraster parameters
+#   imaging        imageengine parameter
+#   items          number of computation inputs (default 1), each a job of
+#                  its own unless batch is set
+#   batch          run the items as one batch (performBatch)
+#   staged         run the job as a staged job (as separate stage tasks,
+#                  which are run in turn here; see tasks.startStages)
+#   large          only run with --large
+Scenarios = {
+    "compute-10k" :        { "rows" : 10000, "fields" : 3, "compute" : "Both" },
+    "compute-100k-fast" :  { "rows" : 100000, "fields" : 3, "compute" : "Python-vectorized" },
+    "compute-constant" :   { "rows" : 10000, "fields" : 2, "constants" : 1, "compute" : "Both" },
+    "compute-1m-stream" :  { "rows" : 1000000, "fields" : 5, "compute" : "Python-vectorized", "large" : True },
+    "raster-300-R" :       { "polygons" : 1000, "raster" : 300, "engine" : "R" },
+    "raster-1000-python" : { "polygons" : 1000, "raster" : 1000, "engine" : "Python" },
+    "raster-3000-deflate" :{ "polygons" : 10000, "raster" : 3000, "engine" : "Python",
+                             "format" : "geoTIFF (tiled, DEFLATE)" },
+    "raster-10000-deflate":{ "polygons" : 10000, "raster" : 10000, "engine" : "Python",
+                             "format" : "geoTIFF (tiled, DEFLATE)", "large" : True },
+    "raster-5000-R" :      { "polygons" : 10000, "raster" : 5000, "engine" : "R", "large" : True },
+    "raster-3000-lzw" :    { "polygons" : 10000, "raster" : 3000, "engine" : "Python",
+                             "format" : "geoTIFF (tiled, LZW)" },
+    "images-300" :         { "polygons" : 1000, "raster" : 300, "engine" : "R", "images" : 1 },
+    "overviews-3000" :     { "polygons" : 10000, "raster" : 3000, "engine" : "Python",
+                             "format" : "geoTIFF (tiled, DEFLATE)", "overviews" : 1,
+                             "images" : 1, "imaging" : "Python" },
+    "images-3000-python" : { "polygons" : 10000, "raster" : 3000, "engine" : "Python",
+                             "format" : "geoTIFF (tiled, DEFLATE)", "images" : 1, "imaging" : "Python" },
+    "raster-unreturned" :  { "polygons" : 1000, "raster" : 300, "engine" : "R", "format" : "None", "images" : 1 },
+    "raster-unreturned-python" : { "polygons" : 1000, "raster" : 300, "engine" : "Python", "format" : "None",
+                                   "images" : 1, "imaging" : "Python" },
+    "jobs-200x100" :       { "rows" : 100, "fields" : 3, "compute" : "Both", "items" : 200 },
+    "batch-200x100" :      { "rows" : 100, "fields" : 3, "compute" : "Both", "items" : 200, "batch" : 1 },
+    "full-job" :           { "rows" : 10000, "fields" : 3, "compute" : "Both",
+                             "polygons" : 1000, "raster" : 1000, "engine" : "Python", "images" : 1 },
+    "staged-full-job" :    { "rows" : 10000, "fields" : 3, "compute" : "Both",
+                             "polygons" : 1000, "raster" : 1000, "engine" : "Python", "images" : 1,
+                             "staged" : 1 },
+    }
+
+# A stage counts as slower than its baseline if it takes this much longer
+# (as a fraction), and at least MinimumSlowdown seconds longer
+Tolerance = 0.25
+MinimumSlowdown = 0.05
+
+def jobConfiguration(scenario, workdir):
+    '''
+    Generate the inputs for a scenario in workdir, returning the
+    input_files and tool_config for FakeJob (input_files is a list of them,
+    one for each item, if the scenario has several items)
+    '''
+    input_files = {}
+    rows = scenario.get("rows", 0)
+    if rows:
+        input_files["computation"] = os.path.join(workdir, "computation.csv")
+        inputs.writeCSV(input_files["computation"], rows, scenario.get("fields", 3))
+        if scenario.get("items", 1) > 1:
+            # The input files of each item (in place of input_files)
+            batch = []
+            for item in range(scenario["items"]):
+                path = os.path.join(workdir, "computation-%d.csv"%(item,))
+                inputs.writeCSV(path, rows, scenario.get("fields", 3), seed=item + 2)
+                batch.append(dict(input_files, computation=path))
+            input_files = batch
+    if scenario.get("polygons"):
+        input_files["rasterize"] = os.path.join(workdir, "rasterize.geojson")
+        inputs.writeGeoJSON(input_files["rasterize"], scenario["polygons"])
+    size = scenario.get("raster", 0)
+    computation = {}
+    if rows:
+        computation = dict( (name, { "type" : "property", "value" : name })
+                            for name in inputs.fieldNames(scenario.get("fields", 3)) )
+        for constant in range(scenario.get("constants", 0)):
+            computation["constant%d"%(constant + 1,)] = { "type" : "number", "value" : constant + 4 }
+    tool_config = {
+        "computation" : computation,
+        "computation_params" : { "computetype" : scenario.get("compute", "None") if rows else "None",
+                                 "raisetopower" : 2 },
+        "computation_output" : { "python_result" : "PowerOfPython", "r_result" : "PowerOfR" },
+        "rasterization_params" : { "dorasterize" : 1 if size else 0,
+                                   "rasterengine" : scenario.get("engine", "R"),
+                                   "raster_x" : size or 300, "raster_y" : size or 300 },
+        "rasterize" : { "rastervalue" : "TAZ" },
+        "rasterization_output" : { "return_raster" : scenario.get("format", "geoTIFF"),
+                                   "raster_basename" : "raster", "return_vector" : 0,
+                                   "raster_overviews" : scenario.get("overviews", 0) },
+        "imaging_params" : { "imagevector" : scenario.get("images", 0),
+                             "imageraster" : scenario.get("images", 0),
+                             "imageengine" : scenario.get("imaging", "R") },
+        "image_output" : { "imageformat" : "PNG" },
+        }
+    return input_files, tool_config
+
+class StageCollector(logging.Handler):
+    '''
+    Collects the stage measurements that performModel logs
+    '''
+    def __init__(self):
+        logging.Handler.__init__(self, logging.INFO)
+        self.stages = []
+
+    def emit(self, record):
+        stage = getattr(record, "configurator_stage", None)
+        if stage:
+            self.stages.append(stage)
+
+def runOnce(name, rserve_latency, nmtk_latency, results):
+    '''
+    Run a scenario (in a child process), putting its measurements on the
+    results queue
+    '''
+    try:
+        workdir = tempfile.mkdtemp(prefix="configurator-bench-")
+        try:
+            input_files, tool_config = jobConfiguration(Scenarios[name], workdir)
+            rserve = fakes.installFakes(os.path.join(fakes.ToolDirectory, "static"),
+                                        os.path.join(workdir, "cache"), rserve_latency)
+            tasks = fakes.loadTool()
+            collector = StageCollector()
+            logging.getLogger().addHandler(collector)
+            logging.getLogger().setLevel(logging.INFO)
+            client = fakes.FakeClient(nmtk_latency)
+            start = time.time()
+            if Scenarios[name].get("batch"):
+                tasks.performBatch(input_files, tool_config, client)
+            elif isinstance(input_files, list):
+                # One job after another, each measured in turn (the stages
+                # reported are those of the last)
+                for item_files in input_files:
+                    del collector.stages[:]
+                    client = fakes.FakeClient(nmtk_latency)
+                    tasks.performModel(item_files, tool_config, client)
+            elif Scenarios[name].get("staged"):
+                tasks.performModel(input_files, tool_config, client, "staged_config")
+            else:
+                tasks.performModel(input_files, tool_config, client)
+            total = time.time() - start
+            stages = dict( (stage["stage"], stage) for stage in collector.stages )
+            results.put({ "scenario" : name,
+                          "total_s" : total,
+                          "failed" : client.failed,
+                          "errors" : (client.results or {}).get("payload"),
+                          "uploaded_bytes" : sum(client.uploaded.values()),
+                          "rserve_connections" : rserve.connections,
+                          "status_updates" : len(client.statuses),
+                          "stages" : stages })
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    except Exception as e:
+        logging.exception("Scenario %s failed"%(name,))
+        results.put({ "scenario" : name, "failed" : True, "errors" : str(e), "stages" : {} })
+
+def median(values):
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle-1] + values[middle]) / 2.0
+
+def runScenario(name, repeat, rserve_latency, nmtk_latency=0.0):
+    '''
+    Run a scenario repeat times, returning the median measurements
+    '''
+    runs = []
+    for attempt in range(repeat):
+        results = multiprocessing.Queue()
+        child = multiprocessing.Process(target=runOnce, args=(name, rserve_latency, nmtk_latency, results))
+        child.start()
+        runs.append(results.get())
+        child.join()
+    summary = { "total_s" : median([ run.get("total_s") for run in runs ]),
+                "failed" : any(run["failed"] for run in runs),
+                "errors" : [ run["errors"] for run in runs if run["failed"] ],
+                "uploaded_bytes" : runs[-1].get("uploaded_bytes"),
+                "status_updates" : runs[-1].get("status_updates"),
+                "stages" : {} }
+    for stage in runs[-1]["stages"]:
+        summary["stages"][stage] = dict( (measure, median([ run["stages"].get(stage, {}).get(measure) for run in runs ]))
+                                         for measure in ("wall_s", "cpu_s", "peak_rss_kb",
+                                                         "read_bytes", "write_bytes", "rserve_round_trips") )
+    return summary
+
+def report(name, summary, baseline=None):
+    print("%s: %s in %.3f s, %s bytes uploaded, %s status updates"%(
+        name, "FAILED" if summary["failed"] else "done", summary["total_s"] or 0,
+        summary["uploaded_bytes"], summary["status_updates"]))
+    for error in summary["errors"]:
+        print("    error: %s"%(error,))
+    print("    %-12s %9s %9s %12s %12s %12s %7s"%("stage", "wall s", "cpu s", "peak RSS kB",
+                                                  "read", "written", "R trips"))
+    def show(value, format):
+        return "" if value is None else format%(value,)
+    order = ("validate", "setup", "parameters", "cache", "compute", "rasterize", "vector image", "raster image",
+             "thumbnail", "results", "upload")
+    for stage in sorted(summary["stages"], key=lambda s: order.index(s) if s in order else len(order)):
+        m = summary["stages"][stage]
+        line = "    %-12s %9s %9s %12s %12s %12s %7s"%(stage, show(m["wall_s"], "%.3f"), show(m["cpu_s"], "%.3f"),
+                                                  show(m["peak_rss_kb"], "%d"), show(m["read_bytes"], "%d"),
+                                                  show(m["write_bytes"], "%d"), show(m["rserve_round_trips"], "%d"))
+        if baseline and stage in baseline.get("stages", {}):
+            before = baseline["stages"][stage]["wall_s"]
+            line += "   (baseline %.3f)"%(before,)
+        print(line)
+
+def slowdowns(name, summary, baseline):
+    '''
+    The stages of a scenario that are slower than the baseline
+    '''
+    slower = []
+    for stage, m in summary["stages"].iteritems():
+        before = baseline.get("stages", {}).get(stage)
+        if before and m["wall_s"] > before["wall_s"] * (1 + Tolerance) and \
+           m["wall_s"] - before["wall_s"] > MinimumSlowdown:
+            slower.append("%s/%s: %.3f s (baseline %.3f s)"%(name, stage, m["wall_s"], before["wall_s"]))
+    return slower
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options] [scenario ...]")
+    parser.add_option("--list", action="store_true", help="list the scenarios")
+    parser.add_option("--repeat", type="int", default=3, help="runs of each scenario (default 3)")
+    parser.add_option("--large", action="store_true", help="include the large scenarios")
+    parser.add_option("--rserve-latency", type="float", default=0.0,
+                      help="seconds added to each Rserve round trip")
+    parser.add_option("--nmtk-latency", type="float", default=0.0,
+                      help="seconds added to each call to the NMTK server")
+    parser.add_option("--baseline", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                         "baselines", platform.node() + ".json"),
+                      help="baseline file (default baselines/<host>.json)")
+    parser.add_option("--save", action="store_true", help="save the results as the baseline")
+    parser.add_option("--compare", action="store_true", help="exit with status 1 if slower than the baseline")
+    options, names = parser.parse_args(argv)
+
+    if options.list:
+        for name in sorted(Scenarios):
+            print("%-22s %s"%(name, json.dumps(Scenarios[name], sort_keys=True)))
+        return 0
+    for name in names:
+        if name not in Scenarios:
+            parser.error("Unknown scenario %s"%(name,))
+    if not names:
+        names = sorted(name for name in Scenarios if options.large or not Scenarios[name].get("large"))
+
+    saved = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as f:
+            saved = json.load(f)
+    baselines = saved.get("scenarios", {})
+
+    results = {}
+    slower = []
+    for name in names:
+        results[name] = runScenario(name, options.repeat, options.rserve_latency, options.nmtk_latency)
+        report(name, results[name], baselines.get(name))
+        if name in baselines:
+            slower.extend(slowdowns(name, results[name], baselines[name]))
+
+    if options.save:
+        baselines.update(results)
+        directory = os.path.dirname(options.baseline)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # (keeping the startup.py baseline, if the file has one)
+        saved.update({ "host" : platform.node(), "python" : platform.python_version(),
+                       "saved" : time.strftime("%Y-%m-%d %H:%M:%S"), "scenarios" : baselines })
+        with open(options.baseline, "w") as f:
+            json.dump(saved, f, indent=1, sort_keys=True)
+        print("Saved baseline %s"%(options.baseline,))
+    if slower:
+        print("Slower than the baseline:")
+        for line in slower:
+            print("    " + line)
+    failed = [ name for name in names if results[name]["failed"] ]
+    if failed or (options.compare and slower):
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
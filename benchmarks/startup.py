@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# Cold start benchmark.
+#
+# A new Celery worker imports tasks.py before it can take a job, and its first
+# job also pays for whatever the tool imports (or connects to) on first use.
+# For each kind of first job, this starts a fresh Python interpreter that
+# installs the stand-ins (see fakes.py), imports tasks.py, then runs the job
+# twice, and reports:
+#
+#   - the time taken to import tasks.py, and the engine modules (NumPy,
+#     pyRserve, billiard ...) that importing it loaded;
+#   - the time taken by the first job and by a second, similar job (so the
+#     difference is what the first job spent on imports and connections),
+#     and the modules and Rserve connections the first job needed.
+#
+# Run from the directory above the tool (or with it on PYTHONPATH):
+#
+#   python -m benchmarks.startup [--repeat 5] [job ...]
+#   python -m benchmarks.startup --check    # fail if importing tasks.py loads
+#                                           # an engine module, or a job that
+#                                           # doesn't use R loads pyRserve
+#   python -m benchmarks.startup --save     # record the times as the baseline
+#   python -m benchmarks.startup --compare  # fail if slower than the baseline
+#
+# The baseline is kept under "startup" in the same file as run.py's.
+
+import json
+import logging
+import optparse
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import fakes
+from . import run
+
+# Modules that tasks.py should only import when a job uses them (pyRserve is
+# always a stand-in here, so whether it was imported is taken from rpool)
+Deferred = ("numpy", "pyRserve", "billiard", "decimal", "uuid", "PIL",
+            fakes.PackageName + ".rasterize", fakes.PackageName + ".geotiff",
+            fakes.PackageName + ".imaging")
+
+# Kinds of first job, as run.py scenarios, and whether each uses R
+Jobs = {
+    "python-compute" : { "rows" : 1000, "fields" : 3, "compute" : "Python-vectorized" },
+    "decimal-compute" : { "rows" : 1000, "fields" : 3, "compute" : "Python" },
+    "R-compute" :      { "rows" : 1000, "fields" : 3, "compute" : "R", "R" : True },
+    "python-raster" :  { "polygons" : 100, "raster" : 300, "engine" : "Python",
+                         "format" : "geoTIFF (tiled, DEFLATE)", "images" : 1, "imaging" : "Python" },
+    "R-raster" :       { "polygons" : 100, "raster" : 300, "engine" : "R", "images" : 1, "R" : True },
+    }
+
+# An import or job counts as slower than its baseline if it takes this much
+# longer (as a fraction), and at least MinimumSlowdown seconds longer
+Tolerance = run.Tolerance
+MinimumSlowdown = 0.02
+
+def loadedModules(tasks, before):
+    '''
+    The Deferred modules that have been imported since before (the names in
+    sys.modules at some earlier point)
+    '''
+    loaded = []
+    for name in Deferred:
+        if name == "pyRserve":
+            if getattr(tasks.rpool.pyRserve, "loaded", True):
+                loaded.append(name)
+        elif name in sys.modules and name not in before:
+            loaded.append(name)
+    return loaded
+
+def measure(name):
+    '''
+    Import tasks.py and run the job name twice (in this process, which
+    should be a fresh interpreter), returning the measurements
+    '''
+    workdir = tempfile.mkdtemp(prefix="configurator-startup-")
+    try:
+        input_files, tool_config = run.jobConfiguration(Jobs[name], workdir)
+        rserve = fakes.installFakes(os.path.join(fakes.ToolDirectory, "static"),
+                                    os.path.join(workdir, "cache"))
+        before = set(sys.modules)
+        start = time.time()
+        tasks = fakes.loadTool()
+        import_s = time.time() - start
+        at_import = loadedModules(tasks, before)
+
+        before = set(sys.modules)
+        start = time.time()
+        client = fakes.FakeClient()
+        tasks.performModel(input_files, tool_config, client)
+        first_s = time.time() - start
+        by_job = loadedModules(tasks, before)
+        connections = rserve.connections
+
+        # Another power, so that the second job isn't answered from the cache
+        tool_config["computation_params"]["raisetopower"] = 3
+        tool_config["rasterization_params"]["raster_x"] += 1
+        start = time.time()
+        second = fakes.FakeClient()
+        tasks.performModel(input_files, tool_config, second)
+        second_s = time.time() - start
+        return { "job" : name, "import_s" : import_s, "first_s" : first_s, "second_s" : second_s,
+                 "at_import" : at_import, "by_job" : [ m for m in by_job if m not in at_import ],
+                 "rserve_connections" : connections,
+                 "failed" : client.failed or second.failed,
+                 "errors" : (client.results or {}).get("payload") if client.failed else None }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def runJob(name, repeat):
+    '''
+    Measure the job name in repeat fresh interpreters, returning the median
+    times (and the modules loaded by the last)
+    '''
+    runs = []
+    # The child imports this module under the name it was imported by here
+    # (benchmarks.startup from the tool's directory, or e.g.
+    # Configurator.benchmarks.startup from the one above), from the
+    # directory holding its top-level package (__name__ is __main__ under -m)
+    module = fakes.__name__.rpartition(".")[0] + ".startup"
+    directory = os.path.abspath(__file__)
+    for level in range(module.count(".") + 1):
+        directory = os.path.dirname(directory)
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join([ directory ] + [ p for p in [ environment.get("PYTHONPATH") ] if p ])
+    for attempt in range(repeat):
+        start = time.time()
+        child = subprocess.Popen([ sys.executable, "-W", "ignore", "-m", module, "--child", name ],
+                                 cwd=directory, env=environment, stdout=subprocess.PIPE)
+        output = child.communicate()[0]
+        process_s = time.time() - start
+        if child.returncode:
+            runs.append({ "job" : name, "failed" : True, "errors" : "exit status %d"%(child.returncode,) })
+            continue
+        measured = json.loads(output.strip().splitlines()[-1])
+        measured["process_s"] = process_s
+        runs.append(measured)
+    summary = dict(runs[-1])
+    for measure in ("process_s", "import_s", "first_s", "second_s"):
+        summary[measure] = run.median([ r.get(measure) for r in runs ])
+    summary["failed"] = any(r["failed"] for r in runs)
+    summary["errors"] = [ r["errors"] for r in runs if r["failed"] ]
+    return summary
+
+def report(summary, baseline=None):
+    def show(value):
+        return "" if value is None else "%.3f"%(value,)
+    line = "%-16s %9s %9s %9s %9s %7s"%(summary["job"], show(summary.get("process_s")), show(summary.get("import_s")),
+                                        show(summary.get("first_s")), show(summary.get("second_s")),
+                                        summary.get("rserve_connections", ""))
+    if baseline:
+        line += "   (baseline %s / %s)"%(show(baseline.get("import_s")), show(baseline.get("first_s")))
+    print(line)
+    if summary.get("at_import"):
+        print("    imported with tasks.py: %s"%(", ".join(summary["at_import"]),))
+    if summary.get("by_job"):
+        print("    imported by the first job: %s"%(", ".join(summary["by_job"]),))
+    for error in summary["errors"]:
+        print("    error: %s"%(error,))
+
+def importProblems(summary):
+    '''
+    What --check fails on for a job: engine modules loaded by importing
+    tasks.py, or pyRserve loaded by a job that doesn't use R
+    '''
+    found = [ "%s: importing tasks.py loaded %s"%(summary["job"], name) for name in summary.get("at_import", []) ]
+    if not Jobs[summary["job"]].get("R") and "pyRserve" in summary.get("by_job", []):
+        found.append("%s: loaded pyRserve without using R"%(summary["job"],))
+    return found
+
+def slowdowns(summary, baseline):
+    '''
+    The import and first job times that are slower than the baseline
+    '''
+    slower = []
+    for measure in ("import_s", "first_s"):
+        before = baseline.get(measure)
+        now = summary.get(measure)
+        if before and now and now > before * (1 + Tolerance) and now - before > MinimumSlowdown:
+            slower.append("%s/%s: %.3f s (baseline %.3f s)"%(summary["job"], measure, now, before))
+    return slower
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options] [job ...]")
+    parser.add_option("--list", action="store_true", help="list the jobs")
+    parser.add_option("--repeat", type="int", default=3, help="interpreters started for each job (default 3)")
+    parser.add_option("--check", action="store_true",
+                      help="exit with status 1 if tasks.py imports an engine module, or a job loads R needlessly")
+    parser.add_option("--baseline", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                         "baselines", platform.node() + ".json"),
+                      help="baseline file (default baselines/<host>.json)")
+    parser.add_option("--save", action="store_true", help="save the results as the baseline")
+    parser.add_option("--compare", action="store_true", help="exit with status 1 if slower than the baseline")
+    parser.add_option("--child", help=optparse.SUPPRESS_HELP)
+    options, names = parser.parse_args(argv)
+
+    if options.child:
+        logging.basicConfig()
+        try:
+            measured = measure(options.child)
+        except Exception as e:
+            measured = { "job" : options.child, "failed" : True, "errors" : str(e) }
+        sys.stdout.write(json.dumps(measured) + "\n")
+        sys.stdout.flush()
+        # Leave without waiting on the tool's idle threads (as a
+        # multiprocessing child would)
+        os._exit(0)
+    if options.list:
+        for name in sorted(Jobs):
+            print("%-16s %s"%(name, json.dumps(Jobs[name], sort_keys=True)))
+        return 0
+    for name in names:
+        if name not in Jobs:
+            parser.error("Unknown job %s"%(name,))
+    names = names or sorted(Jobs)
+
+    saved = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as f:
+            saved = json.load(f)
+    baselines = saved.get("startup", {})
+
+    print("%-16s %9s %9s %9s %9s %7s"%("first job", "process s", "import s", "first s", "second s", "Rserve"))
+    results = {}
+    found = []
+    for name in names:
+        results[name] = runJob(name, options.repeat)
+        report(results[name], baselines.get(name))
+        if options.check:
+            found.extend(importProblems(results[name]))
+        if options.compare and name in baselines:
+            found.extend(slowdowns(results[name], baselines[name]))
+
+    if options.save:
+        baselines.update(results)
+        saved.update({ "host" : platform.node(), "python" : platform.python_version(),
+                       "saved" : time.strftime("%Y-%m-%d %H:%M:%S"), "startup" : baselines })
+        directory = os.path.dirname(options.baseline)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(options.baseline, "w") as f:
+            json.dump(saved, f, indent=1, sort_keys=True)
+        print("Saved baseline %s"%(options.baseline,))
+    if found:
+        print("Problems:")
+        for line in found:
+            print("    " + line)
+    failed = [ name for name in names if results[name]["failed"] ]
+    if failed or found:
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,232 @@
+# Native (Python/NumPy) rendering of preview images of rasters and vectors.
+#
+# This stands in for plotting with R (see plotfunc in R/configurator.R) when
+# the Python imaging engine is chosen:
+#
+#   - a raster is read a block of rows at a time (see geotiff.py) and reduced
+#     to the size of the image as it is read, each pixel being the mean of
+#     the block of cells it covers, so the cost of the image doesn't grow
+#     with the number of cells beyond reading them once (and if the raster
+#     has overviews, the smallest one big enough for the image is read
+#     instead);
+#   - the cells are coloured along a ramp from the lowest to the highest
+#     value (the colours R's raster package uses by default), with empty
+#     cells left transparent (white in a JPEG);
+#   - a vector is drawn as the outlines of its polygons and its lines and
+#     points, scaled to fit the image.
+#
+# PNG images are written here; JPEG needs the Python Imaging Library (PIL or
+# Pillow), and is only offered if it is installed.  Other formats (e.g. PDF)
+# are left to R.
+
+import math
+import struct
+import zlib
+import numpy
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from . import geotiff
+from . import rasterize
+
+# Largest image (width, height) in pixels, as for R's png() device, and of a
+# raster thumbnail
+ImageSize = (480, 480)
+ThumbnailSize = (128, 128)
+
+# Colour ramp, from the lowest value to the highest (R's rev(terrain.colors()))
+Ramp = [ (242, 242, 242), (236, 177, 118), (230, 230, 0), (0, 166, 0) ]
+
+# Colour of the vector outlines
+Outline = (0, 0, 0)
+
+def nativeFormats():
+    '''
+    The image formats (by their ImageFormatTable names) rendered here
+    '''
+    formats = [ "PNG" ]
+    if Image is not None:
+        formats.append("JPG")
+    return formats
+
+def fitImage(width, height, size=ImageSize):
+    '''
+    The (width, height) in pixels of an image of something width by height
+    (in cells or map units), scaled to fit within size
+    '''
+    scale = min(size[0] / float(width), size[1] / float(height))
+    return max(int(round(width * scale)), 1), max(int(round(height * scale)), 1)
+
+class Downsampler(object):
+    '''
+    Reduces a grid of width by height cells, given a block of rows at a
+    time, to one of about out_width by out_height pixels, each the mean of
+    the (non-NaN) cells in the square block of cells it covers
+    '''
+    def __init__(self, width, height, out_width, out_height):
+        self.width = width
+        self.height = height
+        self.factor = max(int(math.ceil(max(width / float(out_width), height / float(out_height)))), 1)
+        self.out_width = (width + self.factor - 1) // self.factor
+        self.out_height = (height + self.factor - 1) // self.factor
+        self.sums = numpy.zeros((self.out_height, self.out_width), dtype=numpy.float64)
+        self.counts = numpy.zeros((self.out_height, self.out_width), dtype=numpy.int64)
+
+    def add(self, row0, rows):
+        '''
+        Add rows (a 2-D array of width columns) starting at row row0
+        '''
+        rows = numpy.asarray(rows, dtype=numpy.float64)
+        padded = numpy.empty((rows.shape[0], self.out_width * self.factor), dtype=numpy.float64)
+        padded.fill(numpy.nan)
+        padded[:, :self.width] = rows
+        padded = padded.reshape(rows.shape[0], self.out_width, self.factor)
+        present = ~numpy.isnan(padded)
+        sums = numpy.where(present, padded, 0.0).sum(axis=2)
+        counts = present.sum(axis=2)
+        pixel_rows = (numpy.arange(row0, row0 + rows.shape[0]) // self.factor)
+        numpy.add.at(self.sums, pixel_rows, sums)
+        numpy.add.at(self.counts, pixel_rows, counts)
+
+    def result(self):
+        '''
+        The reduced grid, with NaN where no cell had a value
+        '''
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            grid = self.sums / self.counts
+        grid[self.counts == 0] = numpy.nan
+        return grid
+
+def colourise(grid, ramp=Ramp):
+    '''
+    Colour a grid along ramp from its lowest to its highest value,
+    returning an RGBA array (height by width by 4, uint8) in which NaN cells
+    are transparent
+    '''
+    rgba = numpy.zeros(grid.shape + (4,), dtype=numpy.uint8)
+    present = ~numpy.isnan(grid)
+    if not present.any():
+        return rgba
+    low, high = grid[present].min(), grid[present].max()
+    position = numpy.zeros(grid.shape, dtype=numpy.float64)
+    if high > low:
+        position[present] = (grid[present] - low) / (high - low) * (len(ramp) - 1)
+    anchors = numpy.arange(len(ramp))
+    for channel in range(3):
+        rgba[..., channel] = numpy.interp(position, anchors, [ colour[channel] for colour in ramp ]).round()
+    rgba[..., 3] = numpy.where(present, 255, 0)
+    return rgba
+
+def pngChunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+def writePNG(path, rgba):
+    '''
+    Write an RGBA array (height by width by 4, uint8) as a PNG
+    '''
+    height, width = rgba.shape[:2]
+    scanlines = numpy.zeros((height, width * 4 + 1), dtype=numpy.uint8)  # filter type 0 (none) on each row
+    scanlines[:, 1:] = rgba.reshape(height, width * 4)
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(pngChunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)))
+        f.write(pngChunk(b"IDAT", zlib.compress(scanlines.tobytes(), 6)))
+        f.write(pngChunk(b"IEND", b""))
+
+def writeImage(path, rgba, imageformat):
+    '''
+    Write an RGBA array as an image in imageformat (one of nativeFormats())
+    '''
+    if imageformat == "PNG":
+        writePNG(path, rgba)
+    elif imageformat == "JPG" and Image is not None:
+        # JPEG has no transparency, so show through to white
+        alpha = rgba[..., 3:4] / 255.0
+        rgb = (rgba[..., :3] * alpha + 255 * (1 - alpha)).round().astype(numpy.uint8)
+        Image.fromarray(rgb, "RGB").save(path, "JPEG", quality=90)
+    else:
+        raise ValueError("Can't write %s images natively"%(imageformat,))
+
+def openForImage(rasterfile, size):
+    '''
+    Open a GeoTIFF raster for an image no bigger than size, returning a
+    GeoTIFFReader for the smallest of its overviews (if it has any) that is
+    still at least as big as the image, or else for the raster itself
+    '''
+    reader = geotiff.GeoTIFFReader(rasterfile)
+    out_width, out_height = fitImage(reader.width, reader.height, size)
+    for page in range(reader.pages - 1, 0, -1):
+        overview = geotiff.GeoTIFFReader(rasterfile, page)
+        if overview.overview and overview.width >= out_width and overview.height >= out_height:
+            reader.close()
+            return overview
+        overview.close()
+    return reader
+
+def renderRaster(rasterfile, outfile, imageformat, size=ImageSize):
+    '''
+    Render a GeoTIFF raster as an image no bigger than size (from an
+    overview, if the raster has a big enough one)
+    '''
+    reader = openForImage(rasterfile, size)
+    try:
+        out_width, out_height = fitImage(reader.width, reader.height, size)
+        downsampler = Downsampler(reader.width, reader.height, out_width, out_height)
+        for row0, rows in reader.blockRows():
+            downsampler.add(row0, rows)
+    finally:
+        reader.close()
+    writeImage(outfile, colourise(downsampler.result()), imageformat)
+
+def drawSegments(rgba, starts, ends, colour):
+    # Draw straight segments from starts to ends (arrays of pixel x,y),
+    # sampling each at one point per pixel along its longer side
+    lengths = numpy.ceil(numpy.abs(ends - starts).max(axis=1)).astype(numpy.int64) + 1
+    segment = numpy.repeat(numpy.arange(len(lengths)), lengths)
+    step = numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+    t = step / numpy.maximum(lengths - 1, 1).astype(numpy.float64)[segment]
+    points = starts[segment] + (ends[segment] - starts[segment]) * t[:, numpy.newaxis]
+    drawPoints(rgba, points, colour)
+
+def drawPoints(rgba, points, colour):
+    height, width = rgba.shape[:2]
+    cols = numpy.clip(numpy.floor(points[:, 0]).astype(numpy.int64), 0, width - 1)
+    rows = numpy.clip(numpy.floor(points[:, 1]).astype(numpy.int64), 0, height - 1)
+    rgba[rows, cols] = colour + (255,)
+
+def renderVector(vectorfile, outfile, imageformat, size=ImageSize):
+    '''
+    Render the outlines of the features in a GeoJSON file as an image no
+    bigger than size
+    '''
+    lines, points = [], []
+    for geometry, properties in rasterize.readGeoJSON(vectorfile):
+        polygons, plines, ppoints = rasterize.flattenGeometry(geometry)
+        lines.extend(ring for polygon in polygons for ring in polygon)
+        lines.extend(plines)
+        points.extend(ppoints)
+    lines = [ numpy.array([ c[:2] for c in line ], dtype=numpy.float64) for line in lines if len(line) > 0 ]
+    points = numpy.array([ p[:2] for p in points ], dtype=numpy.float64).reshape(-1, 2)
+    coords = numpy.concatenate(lines + [points]) if lines else points
+    if not len(coords):
+        raise ValueError("No features to image in %s"%(vectorfile,))
+    xmin, ymin = coords.min(axis=0)
+    xmax, ymax = coords.max(axis=0)
+    width, height = fitImage(max(xmax - xmin, 1e-12), max(ymax - ymin, 1e-12), size)
+    scale = numpy.array([ (width - 1) / max(xmax - xmin, 1e-12), (height - 1) / max(ymax - ymin, 1e-12) ])
+
+    def pixels(xy):
+        # Map coordinates to pixel x,y (y downwards from the top)
+        return (numpy.column_stack((xy[:, 0] - xmin, ymax - xy[:, 1])) * scale) + 0.5
+
+    rgba = numpy.zeros((height, width, 4), dtype=numpy.uint8)
+    if lines:
+        starts = numpy.concatenate([ pixels(line[:-1]) if len(line) > 1 else pixels(line) for line in lines ])
+        ends = numpy.concatenate([ pixels(line[1:]) if len(line) > 1 else pixels(line) for line in lines ])
+        drawSegments(rgba, starts, ends, Outline)
+    if len(points):
+        drawPoints(rgba, pixels(points), Outline)
+    writeImage(outfile, rgba, imageformat)
@@ -0,0 +1,148 @@
+# Lightweight timing and resource instrumentation for the stages of a job.
+#
+# A StageTimer records, for each stage of a job, the wall-clock time, the CPU
+# time used by this process, its peak resident set size so far, the bytes it
+# read and wrote (from /proc/self/io, so this includes socket traffic to Rserve
+# and the NMTK server), and the number of round trips made to Rserve through
+# the connection pool (see rpool.py).  Each stage is logged as it ends, with
+# the measurements attached to the log record, and the measurements can be
+# written out as rows of the job's summary.csv.
+#
+# Stages either follow one another:
+#
+#   stages.begin("compute")      # ends the previous stage, if any
+#   ...
+#   stages.end()
+#
+# or are wrapped around a block:
+#
+#   with stages.span("upload"):
+#       ...
+
+import contextlib
+import threading
+import time
+
+try:
+    import resource
+except ImportError:     # not available on Windows
+    resource = None
+
+from . import rpool
+
+# The measurements recorded for each stage, in the order they're reported
+Measures = ( "wall_s", "cpu_s", "peak_rss_kb", "read_bytes", "write_bytes", "rserve_round_trips" )
+
+def ioCounters():
+    '''
+    The (bytes read, bytes written) by this process so far, or (None, None)
+    if the operating system doesn't say
+    '''
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict( line.split(":",1) for line in f if ":" in line )
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (IOError, OSError, KeyError, ValueError):
+        return None, None
+
+def snapshot():
+    '''
+    The current values of the counters that stage measurements are derived from
+    '''
+    if resource:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu, peak = usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+    else:
+        cpu, peak = time.clock(), None
+    read, written = ioCounters()
+    return { "wall" : time.time(), "cpu" : cpu, "peak" : peak,
+             "read" : read, "written" : written, "trips" : rpool.pool.round_trips }
+
+def difference(after, before, name):
+    if after[name] is None or before[name] is None:
+        return None
+    return after[name] - before[name]
+
+class StageTimer(object):
+    '''
+    Records measurements for the stages of a job; logger (if given) receives
+    an INFO record as each stage ends, and job identifies the job in those
+    records.
+    '''
+    def __init__(self, logger=None, job=None):
+        self.logger = logger
+        self.job = job
+        self.stages = []        # (stage name, measurements), in the order they ended
+        self._current = None    # (stage name, snapshot at start)
+        self._lock = threading.Lock()
+
+    def begin(self, name):
+        '''
+        Start timing stage name, ending the current stage first
+        '''
+        self.end()
+        self._current = (name, snapshot())
+
+    def end(self, failed=False):
+        '''
+        End the current stage (if any), returning its measurements
+        '''
+        if self._current is None:
+            return None
+        name, start = self._current
+        self._current = None
+        return self._record(name, start, snapshot(), failed)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        '''
+        Time the enclosed block as stage name, independently of begin/end
+        (so spans may be nested in, or run alongside, other stages)
+        '''
+        start = snapshot()
+        try:
+            yield
+        except:
+            self._record(name, start, snapshot(), True)
+            raise
+        self._record(name, start, snapshot(), False)
+
+    def _record(self, name, start, finish, failed):
+        measures = { "wall_s" : finish["wall"] - start["wall"],
+                     "cpu_s" : finish["cpu"] - start["cpu"],
+                     "peak_rss_kb" : finish["peak"],
+                     "read_bytes" : difference(finish, start, "read"),
+                     "write_bytes" : difference(finish, start, "written"),
+                     "rserve_round_trips" : finish["trips"] - start["trips"] }
+        with self._lock:
+            self.stages.append((name, measures))
+        if self.logger:
+            self.logger.info("Stage %s %s: %s"%(name, "failed" if failed else "done",
+                                               ", ".join("%s=%s"%(m, measures[m]) for m in Measures)),
+                             extra={ "configurator_stage" : dict(measures, stage=name, job=self.job, failed=failed) })
+        return measures
+
+    def extend(self, stages):
+        '''
+        Add the measurements of stages timed elsewhere (another timer's
+        stages, e.g. from another task of the same job), without logging them
+        again
+        '''
+        with self._lock:
+            self.stages.extend((name, dict(measures)) for name, measures in stages)
+
+    def rows(self):
+        '''
+        The measurements so far as rows for the job's summary.csv (which
+        has Description and Value columns)
+        '''
+        with self._lock:
+            stages = list(self.stages)
+        rows = [ { "Description" : "Section", "Value" : "stages" } ]
+        for name, measures in stages:
+            for measure in Measures:
+                value = measures[measure]
+                rows.append({ "Description" : "Stage-%s-%s"%(name, measure),
+                              "Value" : "" if value is None else
+                                        ("%.6f"%(value,) if isinstance(value, float) else str(value)) })
+        return rows
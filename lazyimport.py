@@ -0,0 +1,44 @@
+# Deferred imports.
+#
+# A Celery worker imports tasks.py when it starts, before it can take its
+# first job, so everything tasks.py imports at the top adds to the time a new
+# worker takes to become useful, whether or not its jobs ever need it.  A
+# LazyModule stands in for a module that is only imported when one of its
+# attributes is first used, so that (say) NumPy or pyRserve are only loaded
+# by a job that computes or rasterizes with them:
+#
+#   numpy = lazyimport.LazyModule("numpy")
+#   geotiff = lazyimport.LazyModule(".geotiff", Package)
+#   numpy.array(...)        # imports numpy here
+
+import importlib
+
+class LazyModule(object):
+    '''
+    Stands in for the module name (relative to package if it starts with a
+    dot, as for importlib.import_module), importing it when first used
+    '''
+    def __init__(self, name, package=None):
+        self.__dict__["_name"] = name
+        self.__dict__["_package"] = package
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        module = self._module
+        if module is None:
+            module = importlib.import_module(self._name, self._package)
+            self.__dict__["_module"] = module
+        return module
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
+
+    def __repr__(self):
+        return "<lazy module %s%s>"%(self._name, "" if self._module is None else " (loaded)")
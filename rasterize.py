@@ -0,0 +1,229 @@
+# Native (Python/NumPy) rasterization of GeoJSON vector files.
+#
+# This produces the same grid as the R path (readOGR -> raster -> rasterize;
+# see rasterizefunc in R/configurator.R) without needing Rserve:
+#
+#   - the raster covers the extent of all the features, divided into ncols by
+#     nrows cells, with row 0 at the top (north) edge;
+#   - a polygon covers a cell if the centre of the cell is inside the polygon
+#     (holes excluded);
+#   - a line covers every cell it passes through;
+#   - a point covers the cell that contains it;
+#   - where features overlap, the last feature in the file wins;
+#   - cells not covered by any feature are NaN (NA in R).
+#
+# Polygons are filled a scanline (a row of cell centres) at a time.  Each
+# feature's bounding box is converted to the range of rows it can touch, so a
+# feature is only looked at for those rows, and a block of rows (see
+# Rasterizer.burn) only looks at the features that overlap it.  Large grids
+# can be rasterized a window of rows at a time (Rasterizer.windows), so that
+# only one window is held in memory.
+
+import json
+import math
+import numpy
+
+def readGeoJSON(path):
+    '''
+    Read the features from a GeoJSON file (a FeatureCollection, a single
+    Feature, or a bare geometry), returning a list of (geometry, properties)
+    '''
+    with open(path) as f:
+        data = json.load(f)
+    if data.get("type") == "FeatureCollection":
+        features = data.get("features", [])
+    elif data.get("type") == "Feature":
+        features = [data]
+    else:
+        features = [{ "geometry" : data, "properties" : {} }]
+    return [ (feature.get("geometry"), feature.get("properties") or {})
+             for feature in features if feature.get("geometry") ]
+
+def flattenGeometry(geometry):
+    '''
+    Break a geometry into its simple parts, returning three lists: polygons
+    (each a list of rings), lines (each a list of coordinates) and points
+    '''
+    polygons, lines, points = [], [], []
+    gtype = geometry.get("type")
+    coords = geometry.get("coordinates")
+    if gtype == "Polygon":
+        polygons.append(coords)
+    elif gtype == "MultiPolygon":
+        polygons.extend(coords)
+    elif gtype == "LineString":
+        lines.append(coords)
+    elif gtype == "MultiLineString":
+        lines.extend(coords)
+    elif gtype == "Point":
+        points.append(coords)
+    elif gtype == "MultiPoint":
+        points.extend(coords)
+    elif gtype == "GeometryCollection":
+        for part in geometry.get("geometries", []):
+            p, l, pt = flattenGeometry(part)
+            polygons.extend(p)
+            lines.extend(l)
+            points.extend(pt)
+    return polygons, lines, points
+
+def featureValue(properties, value):
+    '''
+    The value to burn for a feature: value itself if it is (or converts to) a
+    number, otherwise the feature's attribute of that name (NaN if the
+    feature lacks the attribute or it isn't numeric)
+    '''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return float(properties.get(value))
+    except (TypeError, ValueError):
+        return float('nan')
+
+class Rasterizer(object):
+    '''
+    Rasterizes a list of (geometry, properties) features onto a grid of
+    ncols by nrows cells covering extent (xmin, xmax, ymin, ymax), which
+    defaults to the extent of the features.  value is a constant or the name
+    of a feature attribute (as for the R rasterize "field" argument).
+    '''
+    def __init__(self, features, ncols, nrows, value, extent=None):
+        self.ncols = int(ncols)
+        self.nrows = int(nrows)
+        self.parts = []     # (first row, last row, value, polygons, lines, points)
+        bounds = [ float('inf'), float('-inf'), float('inf'), float('-inf') ]
+        for geometry, properties in features:
+            polygons, lines, points = flattenGeometry(geometry)
+            coords = [ c for polygon in polygons for ring in polygon for c in ring ]
+            coords.extend(c for line in lines for c in line)
+            coords.extend(points)
+            if not coords:
+                continue
+            xy = numpy.array([ c[:2] for c in coords ], dtype=numpy.float64)
+            fbounds = ( xy[:,0].min(), xy[:,0].max(), xy[:,1].min(), xy[:,1].max() )
+            bounds = [ min(bounds[0],fbounds[0]), max(bounds[1],fbounds[1]),
+                       min(bounds[2],fbounds[2]), max(bounds[3],fbounds[3]) ]
+            self.parts.append([ fbounds, featureValue(properties, value),
+                                [ [ numpy.array([ c[:2] for c in ring ], dtype=numpy.float64)
+                                    for ring in polygon if len(ring) > 1 ] for polygon in polygons ],
+                                [ numpy.array([ c[:2] for c in line ], dtype=numpy.float64)
+                                  for line in lines if len(line) > 0 ],
+                                [ tuple(point[:2]) for point in points ] ])
+        if extent is None:
+            extent = tuple(bounds)
+        self.extent = tuple(float(e) for e in extent)
+        xmin, xmax, ymin, ymax = self.extent
+        self.dx = (xmax - xmin) / self.ncols
+        self.dy = (ymax - ymin) / self.nrows
+
+        # The bounding-box index: the range of rows each feature can touch
+        self.index = []
+        for number, part in enumerate(self.parts):
+            fxmin, fxmax, fymin, fymax = part[0]
+            first = max(int(math.floor((ymax - fymax) / self.dy)), 0)
+            last = min(int(math.floor((ymax - fymin) / self.dy)), self.nrows - 1)
+            if last >= first:
+                self.index.append((first, last, number))
+
+    def burn(self, row0=0, row1=None):
+        '''
+        Rasterize rows row0 to row1-1 (by default the whole grid), returning
+        a float64 array of (row1-row0) rows by ncols columns
+        '''
+        if row1 is None:
+            row1 = self.nrows
+        block = numpy.empty((row1 - row0, self.ncols), dtype=numpy.float64)
+        block.fill(numpy.nan)
+        for first, last, number in self.index:  # features in file order, so the last one wins
+            if last < row0 or first >= row1:
+                continue
+            fbounds, value, polygons, lines, points = self.parts[number]
+            rows = (max(first, row0), min(last, row1 - 1))
+            for polygon in polygons:
+                self._burnPolygon(block, row0, rows, polygon, value)
+            for line in lines:
+                self._burnLine(block, row0, line, value)
+            for point in points:
+                self._burnPoint(block, row0, point, value)
+        return block
+
+    def windows(self, rows):
+        '''
+        Rasterize the grid a window of (at most) rows rows at a time,
+        yielding (first row, block) for each window from the top down
+        '''
+        for row0 in xrange(0, self.nrows, rows):
+            yield row0, self.burn(row0, min(row0 + rows, self.nrows))
+
+    def _column(self, x):
+        # The first column whose cell centre is at or to the right of x
+        return int(math.ceil((x - self.extent[0]) / self.dx - 0.5))
+
+    def _burnPolygon(self, block, row0, rows, rings, value):
+        # Even-odd scanline fill through the cell centres of each row, using
+        # all the rings at once so that holes are left out.  Edges are
+        # half-open in y so that a vertex on a scanline is only counted once.
+        edges = [ (ring[:-1], ring[1:]) for ring in rings ]
+        start = numpy.concatenate([ a for a, b in edges ])
+        end = numpy.concatenate([ b for a, b in edges ])
+        x1, y1, x2, y2 = start[:,0], start[:,1], end[:,0], end[:,1]
+        ymax = self.extent[3]
+        for row in xrange(rows[0], rows[1] + 1):
+            y = ymax - (row + 0.5) * self.dy
+            crossing = ((y1 <= y) & (y < y2)) | ((y2 <= y) & (y < y1))
+            if not crossing.any():
+                continue
+            cx1, cy1 = x1[crossing], y1[crossing]
+            xs = cx1 + (y - cy1) * (x2[crossing] - cx1) / (y2[crossing] - cy1)
+            xs.sort()
+            for left, right in zip(xs[0::2], xs[1::2]):
+                c0 = max(self._column(left), 0)
+                c1 = min(self._column(right), self.ncols)
+                if c1 > c0:
+                    block[row - row0, c0:c1] = value
+
+    def _cell(self, x, y):
+        # The (row, column) of the cell containing x,y; points on the right
+        # or bottom edge of the extent belong to the last column or row
+        xmin, xmax, ymin, ymax = self.extent
+        col = min(int(math.floor((x - xmin) / self.dx)), self.ncols - 1)
+        row = min(int(math.floor((ymax - y) / self.dy)), self.nrows - 1)
+        return row, col
+
+    def _burnLine(self, block, row0, line, value):
+        # Walk each segment through the grid: split it wherever it crosses a
+        # cell boundary, and burn the cell holding the middle of each piece
+        xmin, ymax = self.extent[0], self.extent[3]
+        if len(line) == 1:
+            self._burnPoint(block, row0, tuple(line[0]), value)
+            return
+        for (ax, ay), (bx, by) in zip(line[:-1], line[1:]):
+            ts = [ 0.0, 1.0 ]
+            if bx != ax:
+                k0, k1 = sorted(((ax - xmin) / self.dx, (bx - xmin) / self.dx))
+                ks = numpy.arange(math.ceil(k0), math.floor(k1) + 1)
+                ts.extend((xmin + ks * self.dx - ax) / (bx - ax))
+            if by != ay:
+                k0, k1 = sorted(((ymax - ay) / self.dy, (ymax - by) / self.dy))
+                ks = numpy.arange(math.ceil(k0), math.floor(k1) + 1)
+                ts.extend((ymax - ks * self.dy - ay) / (by - ay))
+            ts = numpy.unique(numpy.clip(ts, 0.0, 1.0))
+            mids = (ts[:-1] + ts[1:]) / 2 if len(ts) > 1 else ts
+            for t in mids:
+                self._burnPoint(block, row0, (ax + t * (bx - ax), ay + t * (by - ay)), value)
+
+    def _burnPoint(self, block, row0, point, value):
+        row, col = self._cell(point[0], point[1])
+        if row0 <= row < row0 + block.shape[0] and 0 <= col < self.ncols and row >= 0:
+            block[row - row0, col] = value
+
+def rasterizeFile(vectorfile, ncols, nrows, value):
+    '''
+    Rasterize a GeoJSON file, returning the grid (a float64 array of nrows by
+    ncols, with NaN where there are no features) and its extent as (xmin,
+    xmax, ymin, ymax)
+    '''
+    rasterizer = Rasterizer(readGeoJSON(vectorfile), ncols, nrows, value)
+    return rasterizer.burn(), rasterizer.extent
@@ -0,0 +1,152 @@
+# A simple content-addressed cache of result files on local disk.
+#
+# Each entry is a directory named by its key (a SHA-1 of whatever identifies
+# the results) holding the cached files and an index.json that describes them.
+# Entries are written to a temporary directory and renamed into place, so
+# several worker processes can share one cache directory.  When the files in
+# the cache grow beyond a byte budget, the least recently used entries are
+# removed (a cache hit marks an entry as used by touching its directory).
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+def fileSHA1(path, blocksize=1024*1024):
+    '''
+    The SHA-1 of a file's contents, as a hex string (the same checksum the
+    Linux sha1sum utility reports; see static/Configurator/checksums.txt)
+    '''
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), ""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def cacheKey(*parts):
+    '''
+    Build a cache key from any JSON-serialisable values; dictionaries are
+    serialised with sorted keys so equal values always give the same key.
+    '''
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str)).hexdigest()
+
+def dataSize(data):
+    '''
+    The number of bytes in data, a string or an open file (those from its
+    current position on, which is left where it was)
+    '''
+    if not hasattr(data, "read"):
+        return len(data)
+    position = data.tell()
+    data.seek(0, os.SEEK_END)
+    size = data.tell() - position
+    data.seek(position)
+    return size
+
+class FileCache(object):
+    '''
+    Cache of sets of files in directory, keeping no more than max_bytes of
+    file data.  Each set of files is stored under a key, along with any
+    JSON-serialisable metadata.
+    '''
+    IndexName = "index.json"
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        '''
+        Look up key, returning (metadata, files) where files is a dictionary
+        of name -> path of the cached file, or None if key is not cached.
+        '''
+        entry = self._entry(key)
+        try:
+            with open(os.path.join(entry, self.IndexName)) as f:
+                index = json.load(f)
+            os.utime(entry, None)   # mark as recently used
+        except (IOError, OSError, ValueError):
+            return None
+        files = dict( (name, os.path.join(entry, filename))
+                      for name, filename in index["files"].iteritems() )
+        return index["metadata"], files
+
+    def put(self, key, files, metadata=None):
+        '''
+        Store files (a dictionary of name -> data, where the data is either a
+        string or an open file, which is copied and then rewound) under key.
+        Returns True if the entry was stored.
+        '''
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            os.utime(entry, None)
+            return True
+        # Entries too big for the cache are turned away before anything is
+        # copied
+        if sum(dataSize(data) for data in files.itervalues()) > self.max_bytes:
+            return False
+        staging = tempfile.mkdtemp(dir=self.directory, prefix=".staging-")
+        try:
+            index = { "files" : {}, "metadata" : metadata, "bytes" : 0 }
+            for number, (name, data) in enumerate(sorted(files.iteritems())):
+                filename = str(number)
+                with open(os.path.join(staging, filename), "wb") as f:
+                    if hasattr(data, "read"):
+                        shutil.copyfileobj(data, f)
+                        data.seek(0)
+                    else:
+                        f.write(data)
+                index["files"][name] = filename
+                index["bytes"] += os.path.getsize(os.path.join(staging, filename))
+            if index["bytes"] > self.max_bytes:
+                return False
+            with open(os.path.join(staging, self.IndexName), "w") as f:
+                json.dump(index, f)
+            try:
+                os.rename(staging, entry)
+                staging = None
+            except OSError:
+                # Another worker stored the same results first
+                pass
+        finally:
+            if staging:
+                shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+        return True
+
+    def evict(self):
+        '''
+        Remove the least recently used entries until the cache is within its
+        byte budget (abandoned staging directories are cleared out too).
+        '''
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.startswith(".staging-"):
+                    if os.path.getmtime(path) < time.time() - 3600:
+                        shutil.rmtree(path, ignore_errors=True)
+                    continue
+                with open(os.path.join(path, self.IndexName)) as f:
+                    size = json.load(f)["bytes"]
+                entries.append((os.path.getmtime(path), size, path))
+                total += size
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+        entries.sort()
+        while total > self.max_bytes and entries:
+            used, size, path = entries.pop(0)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -0,0 +1,260 @@
+# A pool of connections to Rserve, kept for the life of a worker process so
+# that each job (and each stage within a job) doesn't have to pay to set up a
+# new connection.
+#
+# Rserve forks a separate R process for each connection, so each pooled
+# connection has its own R workspace.  A connection remembers the job it last
+# served: a stage asking for a connection on behalf of the same job will get
+# that connection back if it is idle (so objects left in the workspace by an
+# earlier stage are still there), while a connection handed to a different
+# job has its workspace cleared first.
+#
+# The pool can also initialise each connection from an R script (loading
+# packages and defining functions) so that jobs find a warm session.  The
+# script is evaluated into an environment attached to the R search path, so
+# clearing the workspace leaves it alone, and the environment is stamped with a
+# hash of the script so that a changed script is picked up on the next checkout.
+#
+# Typical use within a task:
+#
+#   with rpool.pool.connection(job_key) as R:
+#       R.r.value = 3
+#       R.r("value ** 2")
+#
+# The pool counts the round trips made to Rserve (by the pool itself, and
+# through the connections it hands out) in round_trips, for instrumentation.
+
+import contextlib
+import hashlib
+import os
+import threading
+
+from . import lazyimport
+
+# pyRserve (and the NumPy it brings with it) is only imported when the first
+# connection is opened, so workers that never run R jobs don't load it.
+pyRserve = lazyimport.LazyModule("pyRserve")
+
+# The R code that checks a connection: it answers with the version stamp of the
+# initialisation script loaded in the session ("" if none), so the ping and the
+# check for a stale session cost a single round trip.
+PingQuery = 'if (exists("configurator.version")) configurator.version else ""'
+
+class CountingNamespace(object):
+    '''
+    Stands in for a connection's R namespace (conn.r), counting each
+    evaluation, assignment, lookup or function call as a round trip
+    '''
+    def __init__(self, namespace, pool):
+        self.__dict__["_namespace"] = namespace
+        self.__dict__["_pool"] = pool
+
+    def __call__(self, *args, **kwargs):
+        self._pool.count()
+        return self._namespace(*args, **kwargs)
+
+    def __setattr__(self, name, value):
+        self._pool.count()
+        setattr(self._namespace, name, value)
+
+    def __getattr__(self, name):
+        self._pool.count()
+        value = getattr(self._namespace, name)
+        if callable(value):
+            def counted(*args, **kwargs):
+                self._pool.count()
+                return value(*args, **kwargs)
+            return counted
+        return value
+
+class CountingConnection(object):
+    '''
+    Wraps a pyRserve connection so that round trips made through its R
+    namespace are counted by the pool
+    '''
+    def __init__(self, conn, pool):
+        self._conn = conn
+        self.r = CountingNamespace(conn.r, pool)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+class RservePool(object):
+    '''
+    Hands out connections to Rserve, checking each one with a cheap ping
+    before it is used and discarding connections that have gone bad.
+
+    host and port identify the Rserve daemon (pyRserve defaults if not
+    given); max_idle limits how many unused connections are kept open;
+    init_script is the path of an R script used to initialise each session.
+    '''
+    def __init__(self, host=None, port=None, max_idle=4, init_script=None):
+        self.host = host
+        self.port = port
+        self.max_idle = max_idle
+        self.init_script = init_script
+        self._init_mtime = None
+        self._init_source = None
+        self._init_version = ""
+        self._lock = threading.Lock()
+        self._idle = []     # (connection, job key) pairs, most recently used last
+        self._pid = os.getpid()
+        self._count_lock = threading.Lock()
+        self.round_trips = 0
+
+    def count(self, trips=1):
+        '''
+        Add to the number of round trips made to Rserve
+        '''
+        with self._count_lock:
+            self.round_trips += trips
+
+    def _connect(self):
+        kwargs = {}
+        if self.host:
+            kwargs["host"] = self.host
+        if self.port:
+            kwargs["port"] = self.port
+        return pyRserve.connect(**kwargs)
+
+    def _ping(self, conn):
+        # Returns the session's initialisation stamp, or None if the
+        # connection is closed or can't evaluate anything
+        try:
+            if conn.isClosed:
+                return None
+            self.count()
+            return str(conn.r(PingQuery))
+        except Exception:
+            return None
+
+    def _healthy(self, conn):
+        return self._ping(conn) is not None
+
+    def _scriptVersion(self):
+        # Re-read the initialisation script if it has changed on disk
+        if not self.init_script:
+            return ""
+        mtime = os.path.getmtime(self.init_script)
+        if mtime != self._init_mtime:
+            with open(self.init_script) as f:
+                source = f.read()
+            self._init_source = source
+            self._init_version = hashlib.sha1(source).hexdigest()
+            self._init_mtime = mtime
+        return self._init_version
+
+    def _initialise(self, conn):
+        # Evaluate the initialisation script into a fresh "configurator"
+        # environment on the search path, replacing any older one
+        self.count(3)
+        conn.r.configurator_init = self._init_source
+        conn.r.configurator_version = self._init_version
+        conn.r("""
+        local({
+            if ("configurator" %in% search()) detach("configurator")
+            env <- attach(NULL, name="configurator")
+            eval(parse(text=configurator_init), envir=env)
+            assign("configurator.version", configurator_version, envir=env)
+        })
+        rm(configurator_init, configurator_version)
+        """, void=True)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _reset(self, conn):
+        # Clear out anything left behind by another job
+        self.count()
+        conn.r("rm(list=ls(all.names=TRUE)); graphics.off()", void=True)
+
+    def _checkFork(self):
+        # Connections inherited from a parent process share its sockets, so
+        # forget them (without closing) and start afresh in the child.
+        if os.getpid() != self._pid:
+            self._idle = []
+            self._pid = os.getpid()
+
+    def acquire(self, job=None):
+        '''
+        Get a healthy, initialised connection for job (any hashable key
+        identifying the job).  An idle connection that last served the same
+        job is preferred; otherwise the most recently used idle connection is
+        reset and returned, or a new connection is made.
+        '''
+        with self._lock:
+            version = self._scriptVersion()
+        while True:
+            conn = None
+            with self._lock:
+                self._checkFork()
+                for i in range(len(self._idle)-1, -1, -1):
+                    if job is not None and self._idle[i][1] == job:
+                        conn, last_job = self._idle.pop(i)
+                        break
+                else:
+                    if self._idle:
+                        conn, last_job = self._idle.pop()
+            if conn is None:
+                conn = self._connect()
+                stamp = self._ping(conn)
+                last_job = job
+            else:
+                stamp = self._ping(conn)
+                if stamp is None:
+                    self._discard(conn)
+                    continue
+            if last_job != job:
+                self._reset(conn)
+            if stamp != version:
+                self._initialise(conn)
+            return conn
+
+    def release(self, conn, job=None, broken=False):
+        '''
+        Return a connection to the pool.  Broken connections (or any beyond
+        max_idle) are closed instead.
+        '''
+        if broken or conn.isClosed:
+            self._discard(conn)
+            return
+        with self._lock:
+            self._checkFork()
+            self._idle.append((conn, job))
+            excess = self._idle[:-self.max_idle] if self.max_idle else self._idle[:]
+            del self._idle[:len(excess)]
+        for old_conn, old_job in excess:
+            self._discard(old_conn)
+
+    @contextlib.contextmanager
+    def connection(self, job=None):
+        '''
+        Context manager providing a connection for the duration of a stage
+        (wrapped so that its round trips are counted).  If the stage fails, the connection is only kept if it still answers
+        a ping (an R evaluation error leaves the connection usable; a
+        dropped socket does not).
+        '''
+        conn = self.acquire(job)
+        try:
+            yield CountingConnection(conn, self)
+        except:
+            self.release(conn, job, broken=not self._healthy(conn))
+            raise
+        self.release(conn, job)
+
+    def clear(self):
+        '''
+        Close all idle connections.
+        '''
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, job in idle:
+            self._discard(conn)
+
+# The pool shared by all tasks in this worker process, initialising sessions
+# with the tool's R functions
+pool = RservePool(init_script=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                           "R","configurator.R"))
@@ -0,0 +1,101 @@
+# Runs the stages of a job as a small dependency graph.
+#
+# Stages that don't depend on one another (e.g. the computation and the
+# rasterization) run at the same time on separate threads, each taking its own
+# connection from the Rserve pool, so a job takes about as long as its longest
+# chain of dependent stages.  The stages spend most of their time waiting on
+# Rserve, in NumPy or in file I/O, so threads are enough to overlap them.
+#
+#   graph = schedule.StageGraph(timer)
+#   graph.add("compute", computeStage)
+#   graph.add("rasterize", rasterizeStage)
+#   graph.add("raster image", rasterImageStage, after=["rasterize"])
+#   results = graph.run(max_workers=3)
+
+import sys
+import threading
+
+class StageGraph(object):
+    '''
+    A set of named stages, each a function of no arguments that is run once
+    the stages it comes after have finished.  If timer (an
+    instrument.StageTimer) is given, each stage is timed as a span.
+    '''
+    def __init__(self, timer=None):
+        self.timer = timer
+        self.order = []         # stage names, in the order they were added
+        self.stages = {}        # name -> (function, names of the stages it comes after)
+
+    def add(self, name, function, after=()):
+        '''
+        Add a stage, to be run after the (already added) stages named in after
+        '''
+        for dependency in after:
+            if dependency not in self.stages:
+                raise ValueError("Stage %s comes after unknown stage %s"%(name, dependency))
+        self.stages[name] = (function, tuple(after))
+        self.order.append(name)
+
+    def _call(self, name):
+        function = self.stages[name][0]
+        if self.timer:
+            with self.timer.span(name):
+                return function()
+        return function()
+
+    def run(self, max_workers=4):
+        '''
+        Run the stages, up to max_workers at a time (in the order added if
+        max_workers is 1), returning a dictionary of stage name -> the value
+        its function returned.  If a stage raises an exception, the stages
+        that come after it are not run; the other stages are allowed to
+        finish, then the first exception is raised again.
+        '''
+        results = {}
+        if max_workers <= 1:
+            for name in self.order:
+                results[name] = self._call(name)
+            return results
+
+        condition = threading.Condition()
+        finished = set()
+        abandoned = set()       # failed, or coming after a stage that failed
+        running = set()
+        errors = []
+
+        def worker(name):
+            try:
+                value = self._call(name)
+                error = None
+            except Exception:
+                error = sys.exc_info()
+            with condition:
+                running.discard(name)
+                if error:
+                    abandoned.add(name)
+                    errors.append(error)
+                else:
+                    results[name] = value
+                    finished.add(name)
+                condition.notify_all()
+
+        with condition:
+            while True:
+                for name in self.order:
+                    if name in finished or name in abandoned or name in running:
+                        continue
+                    after = self.stages[name][1]
+                    if any(dependency in abandoned for dependency in after):
+                        abandoned.add(name)
+                    elif all(dependency in finished for dependency in after) and len(running) < max_workers:
+                        running.add(name)
+                        thread = threading.Thread(target=worker, args=(name,), name="Stage-"+name)
+                        thread.daemon = True
+                        thread.start()
+                if not running:
+                    break
+                condition.wait()
+        if errors:
+            error_type, error, traceback = errors[0]
+            raise error_type, error, traceback
+        return results
@@ -0,0 +1,172 @@
+# Asynchronous status updates for a job.
+#
+# Each call to the NMTK client's updateStatus is an HTTP round trip to the NMTK
+# server, which the job would otherwise wait for.  A StatusSender stands in
+# front of the client: updateStatus just queues the message, and a background
+# thread sends the queued messages, combining each burst of messages (those
+# arriving within a short window of one another) into a single status update.
+# The sender can also be limited to one update every so many seconds.
+#
+# Before the results go (updateResults), any queued messages are sent and the
+# background thread is stopped, so the server sees the statuses in order and
+# before the results; updateStatus after that sends directly.  stop() also
+# sends the queued messages and waits for the thread to exit (for a job about
+# to fork, which mustn't have other threads running), but the next
+# updateStatus queues as before.  Everything else is passed through to the
+# client.
+#
+#   client = statusqueue.StatusSender(client, window=0.25)
+#   client.updateStatus("Computing")     # returns immediately
+#   client.updateResults(...)            # sends "Computing" first
+
+import threading
+import time
+
+class StatusSender(object):
+    '''
+    Queues status updates for client and sends them from a background
+    thread, combining messages that arrive within window seconds of the
+    first into one update and sending no more than one update every
+    min_interval seconds.  Failures to send are logged (to logger, if given)
+    and otherwise ignored, since status updates are only informative.  The
+    thread exits when it has been idle for idle_timeout seconds and is
+    restarted when needed.
+    '''
+    Separator = "; "
+
+    def __init__(self, client, window=0.25, min_interval=0.0, logger=None, idle_timeout=30.0):
+        self.client = client
+        self.window = window
+        self.min_interval = min_interval
+        self.logger = logger
+        self.idle_timeout = idle_timeout
+        self.sent = 0               # number of updates sent to the client
+        self._pending = []          # messages waiting to be sent
+        self._condition = threading.Condition()
+        self._thread = None
+        self._sending = False
+        self._flushing = False
+        self._stopping = False
+        self._closed = False
+        self._last_sent = 0.0
+
+    def updateStatus(self, message):
+        '''
+        Queue message to be sent
+        '''
+        with self._condition:
+            if not self._closed:
+                self._pending.append(message)
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="StatusSender")
+                    self._thread.daemon = True
+                    self._thread.start()
+                self._condition.notify_all()
+                return
+        self._send([message])
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._pending and not (self._closed or self._stopping):
+                    self._condition.wait(self.idle_timeout)
+                if not self._pending:
+                    self._thread = None
+                    self._condition.notify_all()
+                    return
+                # Let the burst gather, and keep to the rate limit, unless
+                # the queue is being flushed
+                until = max(time.time() + self.window, self._last_sent + self.min_interval)
+                while not (self._flushing or self._closed):
+                    remaining = until - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                messages, self._pending = self._pending, []
+                self._sending = True
+            try:
+                self._send(messages)
+            finally:
+                with self._condition:
+                    self._sending = False
+                    self._last_sent = time.time()
+                    self._condition.notify_all()
+
+    def _send(self, messages):
+        # Combine messages into one update, dropping immediate repeats
+        combined = []
+        for message in messages:
+            if not combined or combined[-1] != message:
+                combined.append(message)
+        try:
+            self.client.updateStatus(self.Separator.join(combined))
+            self.sent += 1
+        except Exception as e:
+            if self.logger:
+                self.logger.debug("Status update failed: %s"%(e,))
+
+    def setMinInterval(self, min_interval):
+        '''
+        Send no more than one update every min_interval seconds from now on
+        '''
+        with self._condition:
+            self.min_interval = min_interval
+            self._condition.notify_all()
+
+    def flush(self):
+        '''
+        Send any queued messages now, returning when they have been sent
+        '''
+        with self._condition:
+            self._flushing = True
+            self._condition.notify_all()
+            try:
+                while self._pending or self._sending:
+                    if self._thread is None:
+                        messages, self._pending = self._pending, []
+                        break
+                    self._condition.wait(0.1)
+                else:
+                    messages = []
+            finally:
+                self._flushing = False
+        if messages:
+            self._send(messages)
+
+    def stop(self):
+        '''
+        Send any queued messages and wait for the background thread to exit
+        (the next updateStatus starts it again)
+        '''
+        self.flush()
+        with self._condition:
+            thread = self._thread
+            self._stopping = True
+            self._condition.notify_all()
+            try:
+                while self._thread is thread and thread is not None:
+                    self._condition.wait(0.1)
+            finally:
+                self._stopping = False
+        if thread is not None:
+            thread.join()
+
+    def close(self):
+        '''
+        Send any queued messages and stop the background thread; later
+        status updates are sent directly
+        '''
+        self.flush()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def updateResults(self, *args, **kwargs):
+        '''
+        Send the queued status updates, then the results
+        '''
+        self.close()
+        return self.client.updateResults(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
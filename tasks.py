@@ -1,16 +1,40 @@
 # At a minimum, you'll want to import the following items to
 # communicate with the NMTK.
 from celery.task import task
+from celery import chain, chord
 import datetime
 
 # For this specific tool, we import the following helpers
 from django.conf import settings
-import NMTK_apps.helpers.confighelpers as Config
-import decimal
+import contextlib
+import itertools
 import os
-import pyRserve
+import shutil
+import tempfile
+
+from . import rpool
+from . import resultcache
+from . import instrument
+from . import statusqueue
+from . import schedule
+from . import validation
+from . import lazyimport
+
+# Modules that only some jobs (or stages) use are imported when first used
+# rather than when the worker starts (see lazyimport.py), so that a worker
+# taking only Python jobs never loads pyRserve (see rpool.py), and none of
+# them holds up a worker's startup; see benchmarks/startup.py.
+Package = __name__.rpartition(".")[0]
+Config = lazyimport.LazyModule("NMTK_apps.helpers.confighelpers")
+decimal = lazyimport.LazyModule("decimal")
+numpy = lazyimport.LazyModule("numpy")
+billiard = lazyimport.LazyModule("billiard")
+rasterize = lazyimport.LazyModule(".rasterize", Package)
+geotiff = lazyimport.LazyModule(".geotiff", Package)
+imaging = lazyimport.LazyModule(".imaging", Package)
 
 import csv
+import json
 import cStringIO as StringIO
 
 # This contains necessary metadata about supported output formats
@@ -21,27 +45,994 @@ ImageFormatTable = {
     }
 
 # Raster Format Table needs to provide:
-#   "File": The base file system name for the generated file (with extension); it will be appended
-#           to a temporary folder path unique for this application
-#   "Load": An R function definition template using % expansion for the base file name to load
-#           a raster dataset from a file in this format,
-#   "Save": An R function definition template using % expansion for the base file name to save the
-#           raster dataset to a file in this format
+#   "extension": The file extension for the generated file; it will be appended to a
+#                temporary file name
+#   "mimetype": The MIME type to use when the raster is returned
+#   "R-format": The format name passed to the savefunc and loadfunc R functions (see
+#               R/configurator.R) to save or load a raster dataset in this format
+# and may also provide:
+#   "R-options": Creation options for savefunc (comma-separated, as for GDAL)
+#   "writer": Options for the native GeoTIFF writer (see geotiff.py), which is
+#             used instead of R to save rasters made by the Python engine
+#             (there is none for LZW, which R's GDAL does far faster)
 RasterFormatTable = {
     "geoTIFF" :                     { "extension" : ".tif",
                                       "mimetype" : "image/tiff",
-                                      "save" : "savefunc<-function(obj){writeRaster(obj,filename='%s',format='GTiff',overwrite=TRUE)}",
-                                      "load" : "loadfunc<-function(){raster('%s')}" },
+                                      "R-format" : "GTiff" },
+    "geoTIFF (tiled, DEFLATE)" :    { "extension" : ".tif",
+                                      "mimetype" : "image/tiff",
+                                      "R-format" : "GTiff",
+                                      "R-options" : "COMPRESS=DEFLATE,TILED=YES",
+                                      "writer" : { "compression" : "DEFLATE", "tile_size" : 256 } },
+    "geoTIFF (tiled, LZW)" :        { "extension" : ".tif",
+                                      "mimetype" : "image/tiff",
+                                      "R-format" : "GTiff",
+                                      "R-options" : "COMPRESS=LZW,TILED=YES" },
     "Erdas Imagine Images (.img)" : { "extension" : ".img",
                                       "mimetype" : "application/octet-stream",
-                                      "save" : "savefunc<-function(obj){writeRaster(obj,filename='%s',format='HFA',overwrite=TRUE)}",
-                                      "load" : "loadfunc<-function(){raster('%s')}" },
+                                      "R-format" : "HFA" },
     "RData" :                       { "extension" : ".rds",
                                       "mimetype" : "application/octet-stream",
-                                      "save" : "savefunc<-function(obj){saveRDS(obj,'%s')}",
-                                      "load" : "loadfunc<-function(){con<-gzfile('%s'); obj<-readRDS(con); close(con); obj}" },
+                                      "R-format" : "RDS" },
     }
 
+# The format of a raster that is made but not returned (the return_raster
+# option is "None"), which both rasterization engines write themselves
+UnreturnedRasterFormat = "geoTIFF (tiled, DEFLATE)"
+
+# Number of values shipped to Rserve in a single call when computing with R.
+# Each chunk costs one round trip to assign the values and one to compute
+# them, rather than a round trip for every cell in the input.
+RComputeChunkSize = 10000
+
+# CSV computation inputs are read once, a chunk of ComputeChunkRows rows at a
+# time, and GeoJSON inputs all at once (see computeFile); the output, in the
+# same format as the input, is written to a spooled file that moves to disk
+# once it grows beyond ComputeSpoolSize bytes.
+ComputeChunkRows = 10000
+ComputeSpoolSize = 4*1024*1024
+
+# When parallel Python computation is requested, columns with at least
+# ParallelThreshold values are split into chunks of ParallelChunkRows values
+# and computed in a pool of worker processes.  Smaller columns are computed in
+# the task's own process, since starting the pool would cost more than it saves.
+ParallelThreshold = 20000
+ParallelChunkRows = 5000
+
+# The results of whole jobs are cached on local disk, keyed on the SHA-1 of
+# the input files and the job parameters, so that resubmitting an identical
+# job just returns the earlier results.  Caches live in the directory named by
+# settings.CONFIGURATOR_CACHE_DIR (or in the system temporary directory), and
+# the job cache keeps no more than ResultCacheBytes of result files.
+# ResultCacheVersion is part of every key: change it whenever a change to the
+# tool changes the results it produces.
+ResultCacheBytes = 512*1024*1024
+ResultCacheVersion = 2
+
+# Rasterization results are cached separately (so jobs that differ in other
+# ways can still share a raster), keyed on the vector file's SHA-1, the raster
+# dimensions, the raster value and the output format, and limited to
+# RasterCacheBytes of raster files.
+RasterCacheBytes = 1024*1024*1024
+
+# Rasters of more than RasterWindowCells cells are rasterized and written a
+# window of RasterWindowRows rows at a time, so that only one window is held
+# in memory (except for the RDS format, which can only be saved whole).
+RasterWindowCells = 4096*4096
+RasterWindowRows = 256
+
+# Status messages arriving within StatusWindow seconds of one another are sent
+# to the NMTK server as a single update, from a background thread, and no more
+# than one update is sent every StatusInterval seconds, unless the job's
+# status_interval parameter says otherwise (see statusqueue.py)
+StatusWindow = 0.25
+StatusInterval = 0.0
+
+# Up to StageWorkers of the stages of a job that don't depend on one another
+# (computation, rasterization and imaging) run at the same time, each with
+# its own R connection (see schedule.py); 1 runs them one after another
+StageWorkers = 3
+
+# Jobs for these subtools (see tool_configs.py) are run as a pipeline of
+# separate Celery tasks, one for each stage (see startStages), rather than in
+# a single task.  Each kind of stage task is sent to its own queue (named in
+# StageQueues, or by CONFIGURATOR_QUEUES in the Django settings), so that
+# each can have workers (and machines) of its own.  The stages pass files to
+# one another in a directory of the job's own, under the directory named by
+# CONFIGURATOR_WORK_DIR in the settings, which must be reachable by all of
+# those workers and by Rserve (by default it is in the system temporary
+# directory, which will only do if they all share one machine).  Rserve may
+# run as a user of its own, which reads the job's files there and writes its
+# rasters and plots alongside them, so each job's directory is given
+# WorkDirectoryMode (or CONFIGURATOR_WORK_DIR_MODE in the settings) rather
+# than being private to the worker's user.  The default lets anyone in, like
+# the system temporary directory the monolithic jobs use.
+StagedTools = [ "staged_config" ]
+WorkDirectoryMode = 0o777
+StageQueues = {
+    "compute" :   "configurator.compute",
+    "rasterize" : "configurator.rasterize",
+    "image" :     "configurator.image",
+    "publish" :   "configurator.publish",
+    }
+
+# Parameters that don't affect the results (e.g. names of temporary files),
+# which are left out of the cache key
+CacheVolatile = {
+    "compute" : [ "parallel" ],
+    "raster" : [ "vectorfile", "rasterfile" ],
+    }
+
+def cacheDirectory(name):
+    '''
+    The directory for the named cache
+    '''
+    base = getattr(settings, 'CONFIGURATOR_CACHE_DIR', None)
+    if not base:
+        base = os.path.join(tempfile.gettempdir(), "Configurator-cache")
+    return os.path.join(base, name)
+
+def stageQueue(stage):
+    '''
+    The queue for the named kind of stage task
+    '''
+    return getattr(settings, 'CONFIGURATOR_QUEUES', {}).get(stage, StageQueues[stage])
+
+def workDirectory():
+    '''
+    The directory holding the work directories of staged jobs (created if
+    need be)
+    '''
+    base = getattr(settings, 'CONFIGURATOR_WORK_DIR', None)
+    if not base:
+        base = os.path.join(tempfile.gettempdir(), "Configurator-work")
+    try:
+        os.makedirs(base)
+    except OSError:
+        if not os.path.isdir(base):
+            raise
+    return base
+
+def relocated(value, moves):
+    '''
+    A copy of value (e.g. input_files) with any of the file names in moves
+    (old name -> new name) replaced, wherever they appear in it
+    '''
+    if isinstance(value, basestring):
+        return moves.get(value, value)
+    if isinstance(value, dict):
+        return dict( (key, relocated(item, moves)) for key, item in value.iteritems() )
+    if isinstance(value, (list, tuple)):
+        return type(value)(relocated(item, moves) for item in value)
+    return value
+
+def statusInterval(job_parameters):
+    '''
+    The least number of seconds between the job's status updates: its
+    status_interval parameter, if given, or else StatusInterval
+    '''
+    interval = job_parameters['status_output'].get('status_interval', StatusInterval)
+    if interval < 0:
+        raise validation.ParameterError(["status_output.status_interval: %r is negative"%(interval,)])
+    return interval
+
+def jobCacheKey(parameters, checksums):
+    '''
+    The result cache key for a job: the SHA-1 of each of its input files
+    (checksums is a dictionary of namespace -> SHA-1) plus its parameters
+    (less the volatile ones), all as strings.
+    '''
+    normalised = {}
+    for section, values in parameters.iteritems():
+        volatile = CacheVolatile.get(section, [])
+        normalised[section] = dict( (name, str(value)) for name, value in values.iteritems()
+                                    if name not in volatile )
+    return resultcache.cacheKey(ResultCacheVersion, normalised, checksums)
+
+def rasterCacheKey(raster, vector_checksum):
+    '''
+    The raster cache key for a rasterization: the vector file's SHA-1, the
+    raster dimensions, the raster value (constant or field name), the format
+    (as named in RasterFormatTable), the engine and whether it has overviews
+    '''
+    return resultcache.cacheKey(ResultCacheVersion, vector_checksum,
+                                str(raster["x_dim"]), str(raster["y_dim"]),
+                                str(raster["value"]), raster["format"], raster["engine"],
+                                str(bool(raster["overviews"])))
+
+def linkOrCopy(source, destination):
+    '''
+    Make destination a hard link to source (which costs nothing and survives
+    the source being removed), or a copy if they're on different devices
+    '''
+    try:
+        os.link(source, destination)
+    except (OSError, AttributeError):
+        shutil.copyfile(source, destination)
+
+def openCachedResults(cached):
+    '''
+    Turn a job cache entry into a dictionary of result files suitable for
+    client.updateResults (the files are opened, and must be closed by the
+    caller).  Returns (result_file, files), or None if the entry is missing
+    or has vanished from the disk in the meantime.
+    '''
+    if not cached:
+        return None
+    metadata, paths = cached
+    outfiles = {}
+    try:
+        for slug, (displayname, mimetype) in metadata["files"].iteritems():
+            outfiles[slug] = ( displayname, open(paths[slug],"rb"), mimetype )
+    except (IOError, KeyError):
+        for displayname, data, mimetype in outfiles.itervalues():
+            data.close()
+        return None
+    return metadata["result_file"], outfiles
+
+def summaryMeasures(stages, cache_hit):
+    '''
+    The rows that end a job's summary.csv: whether its results came from the
+    job cache, then the measurements of its own stages (the job cache keeps
+    summaries without these, since they belong to the job that made them)
+    '''
+    return [ { "Description" : "Section", "Value" : "cache" },
+             { "Description" : "Cache-hit", "Value" : str(int(cache_hit)) } ] + stages.rows()
+
+@contextlib.contextmanager
+def optionalConnection(needed, job_key):
+    '''
+    Provide a pooled R connection for a stage if needed, otherwise None
+    '''
+    if needed:
+        with rpool.pool.connection(job_key) as R:
+            yield R
+    else:
+        yield None
+
+def asFloat(value):
+    '''
+    Convert an input value (usually a string) to a float, returning NaN for
+    anything that won't convert (which is what R's as.numeric would do).
+    '''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+def computeDecimal(value, pyPower):
+    '''
+    Raise a single value to pyPower (a Decimal) using Python decimal math.
+    Values that won't convert to a number give "NaN-Python".
+    '''
+    try:
+        pyValue = decimal.Decimal(str(value))
+    except:
+        pyValue = decimal.Decimal.from_float(float('nan'))
+    if not pyValue.is_nan():
+        return pyValue ** pyPower
+    return "NaN-Python"
+
+def computeColumnPython(values, power, exact=False):
+    '''
+    Compute a whole column of values raised to power.  Unless exact is
+    requested, the column is converted to a float64 array and raised to the
+    power by NumPy in one operation.  Cells that don't convert to a number
+    are returned as "NaN-Python"; cells whose float result isn't finite
+    (overflow, or a negative value raised to a fractional power) are
+    recomputed one at a time with decimal math.  If exact is requested,
+    every cell is computed with decimal math.
+    '''
+    pyPower = decimal.Decimal(str(power))
+    if exact:
+        return [computeDecimal(v, pyPower) for v in values]
+
+    inputs = numpy.array([asFloat(v) for v in values], dtype=numpy.float64)
+    with numpy.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        computed = numpy.power(inputs, float(pyPower))
+    results = computed.tolist()
+    for i in numpy.flatnonzero(~numpy.isfinite(computed)):
+        if numpy.isnan(inputs[i]):
+            results[i] = "NaN-Python"
+        else:
+            try:
+                results[i] = computeDecimal(values[i], pyPower)
+            except decimal.DecimalException:
+                results[i] = "NaN-Python"
+    return results
+
+def computePythonValues(values, power, engine, exact=False):
+    '''
+    Compute a list of values raised to power with the named Python engine
+    ("vectorized" or "decimal")
+    '''
+    if engine == "vectorized":
+        return computeColumnPython(values, power, exact=exact)
+    pyPower = decimal.Decimal(str(power))
+    return [computeDecimal(v, pyPower) for v in values]
+
+def computePythonChunk(args):
+    '''
+    Entry point for the worker processes of ComputePool (which can only pass
+    a single argument)
+    '''
+    return computePythonValues(*args)
+
+class ComputePool(object):
+    '''
+    Computes Python results across a pool of processes sized to the available
+    cores, returning the results in the original order.  The pool is started
+    by start(), or else once a column of at least threshold values turns up;
+    shorter columns are computed in this process.  Call close() when done.
+
+    The pool comes from billiard (Celery's fork of multiprocessing) since
+    Celery's worker processes are daemonic and multiprocessing won't let them
+    start children of their own.
+    '''
+    def __init__(self, processes=None, threshold=ParallelThreshold, chunk_rows=ParallelChunkRows):
+        self.processes = processes or billiard.cpu_count()
+        self.threshold = threshold
+        self.chunk_rows = chunk_rows
+        self._pool = None
+
+    def start(self):
+        '''
+        Start the worker processes now, returning the pool.  A pool that is
+        to be used from a thread must be started before other threads are,
+        since a process forked while another thread holds a lock (logging's,
+        say) can wait on that lock for ever.
+        '''
+        if self._pool is None and self.processes >= 2:
+            self._pool = billiard.Pool(self.processes)
+        return self
+
+    def compute(self, values, power, engine, exact=False):
+        if len(values) < self.threshold or self.processes < 2:
+            return computePythonValues(values, power, engine, exact)
+        self.start()
+        chunks = [ (values[start:start+self.chunk_rows], power, engine, exact)
+                   for start in xrange(0, len(values), self.chunk_rows) ]
+        return list(itertools.chain.from_iterable(self._pool.map(computePythonChunk, chunks)))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+def computeColumnR(R, values, power, chunk_size=RComputeChunkSize):
+    '''
+    Compute a whole column of values raised to power with the R "compute"
+    function (see R/configurator.R), shipping the values to Rserve in chunks
+    of chunk_size and getting back a vector of results for each chunk.
+    Elements that R computes as NaN or NA are returned as "Nan-R", just as
+    the single-value computation did.
+    '''
+    results = []
+    R.r.rpower = power
+    for start in xrange(0, len(values), chunk_size):
+        R.r.rvalues = numpy.array([asFloat(v) for v in values[start:start+chunk_size]],
+                                  dtype=numpy.float64)
+        # pyRserve hands back a scalar for a vector of length 1
+        computed = numpy.atleast_1d(R.r("compute(rvalues,rpower)"))
+        results.extend("Nan-R" if numpy.isnan(r) else float(r) for r in computed)
+    return results
+
+def computeColumns(columns, compute, R=None, python_pool=None):
+    '''
+    Compute the results for a dictionary of field -> list of values with the
+    engines requested in compute (R results need a connection, R; Python
+    results are spread across python_pool if one is given).  Returns a
+    dictionary of field -> list of (result field name, list of results), with
+    the Python results ahead of the R results.
+    '''
+    results = {}
+    for field, values in columns.iteritems():
+        fieldresults = results[field] = []
+        engine = compute["python_engine"]
+        if compute["with_Python"]:
+            exact = compute["precision"] == "Exact"
+            if python_pool:
+                pyresults = python_pool.compute(values, compute["power"], engine, exact)
+            else:
+                pyresults = computePythonValues(values, compute["power"], engine, exact)
+            fieldresults.append((compute["PythonName"]+"_"+field, pyresults))
+        if compute["with_R"]:
+            fieldresults.append((compute["RName"]+"_"+field,
+                                 computeColumnR(R, values, compute["power"])))
+    return results
+
+def resultNames(field, compute):
+    '''
+    The names of the result fields computed for an input field, in the order
+    computeColumns gives them
+    '''
+    names = []
+    if compute["with_Python"]:
+        names.append(compute["PythonName"]+"_"+field)
+    if compute["with_R"]:
+        names.append(compute["RName"]+"_"+field)
+    return names
+
+def computeFields(job):
+    '''
+    The fields of the job's computation input, as (fields, constants): a
+    dictionary of the tool's field name -> the name of the input's column (or
+    property) mapped to it, for the fields of type "property", and one of
+    field name -> value, for the fields given a constant value instead (which
+    is computed for every row, as if it were a column of that value)
+    '''
+    fields = {}
+    constants = {}
+    for field, mapping in job.getParameters('computation').iteritems():
+        if isinstance(mapping, dict):
+            value = mapping.get("value")
+            if value is None or value == "":
+                continue
+            if mapping.get("type", "property") == "property":
+                fields[field] = value
+            else:
+                constants[field] = value
+        elif mapping:
+            fields[field] = mapping
+    return fields, constants
+
+def computeCSV(datafile, fields, constants, compute, R, outfile, chunk_rows=ComputeChunkRows, python_pool=None):
+    '''
+    Compute the results for a CSV computation input (the file datafile, whose
+    columns are mapped to the tool's fields by fields, with the constant
+    fields in constants; see computeFields) a chunk of chunk_rows rows at a
+    time, writing each row to outfile as it was read, followed by its
+    results, once its chunk is computed, so only one chunk is ever held in
+    memory.  The result columns follow the input's columns, in order of
+    field name.  Returns the number of rows written.
+    '''
+    with open(datafile, "rb") as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        columns = {}
+        for field, column in fields.iteritems():
+            if column not in header:
+                raise Exception("The computation input has no %s column (for %s)"%(column,field))
+            columns[field] = header.index(column)
+        order = sorted(set(columns) | set(constants))
+        writer = csv.writer(outfile)
+        writer.writerow(header + [ name for field in order for name in resultNames(field, compute) ])
+        nrows = 0
+        while True:
+            rows = list(itertools.islice(reader, chunk_rows))
+            if not rows:
+                break
+            chunk = dict( (field, [ row[index] if index < len(row) else None for row in rows ])
+                          for field, index in columns.iteritems() )
+            for field, value in constants.iteritems():
+                chunk[field] = [ value ] * len(rows)
+            results = computeColumns(chunk, compute, R, python_pool=python_pool)
+            del chunk
+            results = [ values for field in order for name, values in results[field] ]
+            for position, row in enumerate(rows):
+                writer.writerow(row + [ values[position] for values in results ])
+            nrows += len(rows)
+    return nrows
+
+def computeGeoJSON(datafile, fields, constants, compute, R, outfile, python_pool=None):
+    '''
+    Compute the results for a GeoJSON computation input (the file datafile,
+    whose properties are mapped to the tool's fields by fields, with the
+    constant fields in constants; see computeFields), adding them to the properties of each feature, and write
+    the whole collection to outfile.  (GeoJSON can't be read a piece at a
+    time, so the input is held in memory, as the NMTK's reading of it would
+    be.)  Exact decimal results are written as strings.  Returns the number
+    of features written.
+    '''
+    with open(datafile, "rb") as f:
+        collection = json.load(f)
+    features = collection.get("features") or []
+    for feature in features:
+        if feature.get("properties") is None:
+            feature["properties"] = {}
+    chunk = dict( (field, [ feature["properties"].get(column) for feature in features ])
+                  for field, column in fields.iteritems() )
+    for field, value in constants.iteritems():
+        chunk[field] = [ value ] * len(features)
+    results = computeColumns(chunk, compute, R, python_pool=python_pool)
+    del chunk
+    for field in sorted(results):
+        for name, values in results[field]:
+            for feature, value in itertools.izip(features, values):
+                feature["properties"][name] = value
+    json.dump(collection, outfile, default=unicode)
+    return len(features)
+
+def computeFeatures(compute_file, compute, R):
+    '''
+    Compute the results for the computation input a row at a time as the NMTK
+    job helper reads it (compute_file), adding them to each row as it goes,
+    with one R round trip for each row.  Returns the number of rows.
+    '''
+    exact = compute.get("precision") == "Exact"
+    nrows = 0
+    for row in compute_file:
+        fields = list(row)
+        values = [ row[field] for field in fields ]
+        if compute["with_Python"]:
+            pyresults = computePythonValues(values, compute["power"], compute["python_engine"], exact)
+        if compute["with_R"]:
+            Rresults = computeColumnR(R, values, compute["power"])
+        for position, field in enumerate(fields):
+            if compute["with_Python"]:
+                compute_file.addResult(compute["PythonName"]+"_"+field, pyresults[position])
+            if compute["with_R"]:
+                compute_file.addResult(compute["RName"]+"_"+field, Rresults[position])
+        nrows += 1
+    return nrows
+
+def computeParameters(job_parameters):
+    '''
+    Set up the computation from the job parameters (as checked by
+    validation.py), returning the dictionary of settings that computeFile
+    uses (all but "fields" and "constants", which come from the job; see
+    computeFields) and
+    a status message describing them
+    '''
+    compute = {}
+    compute_factors = job_parameters['computation_params']
+
+    #   Determine specific computational engines to use, if any
+    computetype    = compute["type"] = compute_factors['computetype']
+
+    #   Notify the user via a status update
+    if computetype != 'None':
+        compute_R      = compute["with_R"] = computetype in ['R','Both']
+        compute_Python = compute["with_Python"] = computetype in ['Python','Both','Python-vectorized']
+        if computetype == 'Python-vectorized':
+            compute["python_engine"] = "vectorized"
+        else:
+            compute["python_engine"] = "decimal"
+
+        if compute_R or compute_Python:
+            computemsg = "Computation will occur using"
+            if compute_R:
+                computemsg += " R"
+                if compute_Python:
+                    computemsg += " and"
+            if compute_Python:
+                computemsg += " Python"
+                if compute["python_engine"] == "vectorized":
+                    computemsg += " (vectorized)"
+        else:
+            computemsg = "Computation will not occur"
+
+        #   Determine parameter; default is to square it same as /tool_config
+        compute["power"] = compute_factors['raisetopower']
+
+        #   Vectorized Python computes in floating point unless exact
+        #   (decimal) results are requested
+        compute["precision"] = compute_factors['computeprecision']
+
+        #   Python computation may be spread across processes (for
+        #   large enough inputs)
+        compute["parallel"] = compute_factors['parallel']
+
+        #   Determine what to return (result file)
+        compute_output = job_parameters['computation_output']
+        compute["PythonName"] = compute_output['python_result']
+        compute["RName"] = compute_output['r_result']
+    else:
+        computemsg = "Computation was not requested."
+    return compute, computemsg
+
+def computeFile(compute_file, datafile, compute, R, python_pool, logger):
+    '''
+    Compute the requested results for the computation input, with the R
+    connection R (if R results are requested) and python_pool (if the Python
+    results are to be spread across processes).  compute_file is the input
+    as the NMTK job helper reads it, and datafile the file itself.
+
+    The input is read just once.  CSV and GeoJSON inputs are read straight
+    from datafile, with the results of whole columns (or chunks of them)
+    computed at a time, and written with everything else in the input (in
+    the same format) to a spool file, which is returned.  Other inputs are
+    computed a row at a time through compute_file, which the results are
+    added to, and None is returned.
+    '''
+    compute_spool = None
+    if not (compute.get("with_R", False) or compute.get("with_Python", False)):
+        return compute_spool
+
+    # Remember that all parameters, regardless of their stated type, arrive
+    # in the tool as string representations (the promise is just that the
+    # string will probably convert successfully to the tool_config type).
+    # Thus all the computation code should perform idempotent conversions...
+    extension = compute_file.extension.lower()
+    if extension in ("csv", "geojson", "json"):
+        compute_spool = tempfile.SpooledTemporaryFile(max_size=ComputeSpoolSize)
+        try:
+            if extension == "csv":
+                # Chunks big enough to be worth spreading across processes
+                chunk_rows = ComputeChunkRows
+                if python_pool:
+                    chunk_rows = max(chunk_rows, python_pool.threshold)
+                nrows = computeCSV(datafile, compute["fields"], compute["constants"], compute, R, compute_spool,
+                                   chunk_rows=chunk_rows, python_pool=python_pool)
+            else:
+                nrows = computeGeoJSON(datafile, compute["fields"], compute["constants"], compute, R, compute_spool,
+                                       python_pool=python_pool)
+        except:
+            compute_spool.close()
+            raise
+        compute_spool.seek(0)
+    else:
+        nrows = computeFeatures(compute_file, compute, R)
+    logger.debug("Computed results for %d rows"%(nrows,))
+    return compute_spool
+
+def computationResult(compute_file, compute_spool, basename="computation"):
+    '''
+    The (file name, data, MIME type) of the computation results, in the
+    format of the input: the spool file written by computeFile if there is
+    one, or else compute_file with the results added
+    '''
+    data = compute_spool if compute_spool else compute_file.getDataFile()
+    return ( '%s.%s'%(basename, compute_file.extension), data, compute_file.content_type )
+
+def computePool(compute, client):
+    '''
+    A started ComputePool for the Python computation, if parallel computation
+    was requested (otherwise None).  The processes are forked with no other
+    threads running (see ComputePool.start), so the client's status sender
+    (a statusqueue.StatusSender) is stopped first; it starts again with the
+    next status update.
+    '''
+    if compute.get("with_Python", False) and compute["parallel"]:
+        client.stop()
+        return ComputePool().start()
+    return None
+
+def computeStage(compute_file, datafile, compute, python_pool, job_key, client, logger):
+    '''
+    Compute the requested results for the computation input (see
+    computeFile), with a pooled R connection if needed and python_pool (see
+    computePool), which the caller closes
+    '''
+    with optionalConnection(compute.get("with_R", False), job_key) as R:
+        compute_spool = computeFile(compute_file, datafile, compute, R, python_pool, logger)
+
+    client.updateStatus('Done with computations')
+
+    return compute_spool
+
+def rasterizeStage(raster, vector_checksum, job_key, client, logger):
+    '''
+    Rasterize raster["vectorfile"] into raster["rasterfile"] (or fetch it from
+    the raster cache), returning a list of the files written here rather than
+    by R, which Python must remove
+    '''
+    # Take the input vector (either a supplied or default file) and pass it
+    # through the R (or native) rasterization.  If rasterization was NOT
+    # requested, but imaging of a raster was, the default raster from the
+    # world of static data is used instead, and this stage isn't run
+
+    # Rasterized files that Python (rather than R) has written, and
+    # will remove when done
+    pytempfiles = []
+
+    # An identical rasterization may already be in the raster cache
+    raster["cached"] = 0
+    if raster["rasterfile"]:
+        raster_cache = resultcache.FileCache(cacheDirectory("rasters"), RasterCacheBytes)
+        raster_key = rasterCacheKey(raster, vector_checksum)
+        cached = raster_cache.get(raster_key)
+        if cached:
+            try:
+                linkOrCopy(cached[1]["raster"], raster["rasterfile"])
+                pytempfiles.append(raster["rasterfile"])
+                raster["cached"] = 1
+                client.updateStatus('Using cached rasterization.')
+            except (IOError, OSError) as e:
+                logger.debug("Raster cache failed: "+str(e))
+
+    xdim = int(float(raster["x_dim"]))
+    ydim = int(float(raster["y_dim"]))
+    windowed = xdim * ydim > RasterWindowCells and raster["rformat"] != "RDS"
+    if windowed:
+        logger.debug("Rasterizing %d by %d cells in windows of %d rows"%(xdim,ydim,RasterWindowRows))
+
+    if not raster["cached"] and raster["engine"] == "Python":
+        # Burn the features into a grid here, and save it with the
+        # native writer if the format has one, or else hand the grid
+        # to R to be saved in the requested format
+        rasterizer = rasterize.Rasterizer(rasterize.readGeoJSON(raster["vectorfile"]),
+                                          xdim, ydim, raster["value"])
+        if raster["writer"]:
+            writer = geotiff.GeoTIFFWriter(raster["rasterfile"], xdim, ydim, rasterizer.extent,
+                                           overviews=bool(raster["overviews"]), **raster["writer"])
+            pytempfiles.append(raster["rasterfile"])
+            for row0, block in rasterizer.windows(RasterWindowRows if windowed else ydim):
+                writer.write(block)
+            writer.close()
+        elif windowed:
+            with rpool.pool.connection(job_key) as R:
+                R.r.gridextent = numpy.array(rasterizer.extent)
+                R.r.xdim = xdim
+                R.r.ydim = ydim
+                R.r.rasterfile = raster["rasterfile"]
+                R.r.rasterformat = raster["rformat"]
+                R.r.rasteroptions = raster["roptions"]
+                R.r("rsa <- startfunc(rasterfile,rasterformat,rasteroptions,gridextent,xdim,ydim)", void=True)
+                for row0, block in rasterizer.windows(RasterWindowRows):
+                    R.r.gridvalues = block.ravel()
+                    R.r.gridrow = row0 + 1
+                    R.r("rsa <- writefunc(rsa,gridvalues,gridrow)", void=True)
+                R.r('rsa <- stopfunc(rsa,rasterfile,"rsa")', void=True)
+        else:
+            grid = rasterizer.burn()
+            with rpool.pool.connection(job_key) as R:
+                R.r.gridvalues = grid.ravel()   # row by row from the top, as R's raster expects
+                R.r.gridextent = numpy.array(rasterizer.extent)
+                R.r.xdim = xdim
+                R.r.ydim = ydim
+                R.r.rasterfile = raster["rasterfile"]
+                R.r.rasterformat = raster["rformat"]
+                R.r.rasteroptions = raster["roptions"]
+                R.r("""
+                    rsa <- gridfunc(gridvalues,gridextent,xdim,ydim)
+                    savefunc(rsa,rasterfile,rasterformat,rasteroptions,"rsa")
+                    """, void=True)
+            del grid
+        del rasterizer
+    elif not raster["cached"]:
+        with rpool.pool.connection(job_key) as R:
+            R.r.vectorfile = raster["vectorfile"] # File to rasterize
+            R.r.rasterfile = raster["rasterfile"] # File to save the raster into
+            R.r.rasterformat = raster["rformat"]  # ...and its format
+            R.r.rasteroptions = raster["roptions"]  # ...and creation options
+            R.r.xdim = raster["x_dim"]  # Desired raster resolution, x and y
+            R.r.ydim = raster["y_dim"]
+            R.r.rastervalue = raster["value"] # Value for raster cells,  either text/fieldname or numeric value
+            # Rasterize the input file (see rasterizefunc and
+            # rasterizetiledfunc in R/configurator.R) and write it out in a
+            # suitable format for returning or later plotting
+            if windowed:
+                R.r.windowrows = RasterWindowRows
+                R.r("""
+                    rsa <- rasterizetiledfunc(vectorfile,xdim,ydim,rastervalue,rasterfile,rasterformat,rasteroptions,windowrows)
+                    rsa <- stopfunc(rsa,rasterfile,"rsa")
+                    """, void=True)
+            else:
+                R.r("""
+                    rsa <- rasterizefunc(vectorfile,xdim,ydim,rastervalue)
+                    savefunc(rsa,rasterfile,rasterformat,rasteroptions,"rsa")
+                    """, void=True)
+
+    if not raster["cached"] and raster["rasterfile"]:
+        try:
+            with open(raster["rasterfile"],"rb") as rasterdata:
+                raster_cache.put(raster_key, { "raster" : rasterdata })
+        except Exception as e:
+            logger.debug("Caching raster failed: "+str(e))
+
+    return pytempfiles
+
+def imageStage(kind, raster, image, job_key, client, logger, workdir=None):
+    '''
+    Plot the input vector (kind "vector") or the raster (kind "raster") into a
+    temporary image file (in workdir, if given), returning (its name, True if it was written here
+    rather than by R), or ("", False) if imaging failed.
+
+    With the Python engine, PNG (and JPEG, if PIL is installed) images of
+    vectors and geoTIFF rasters are drawn natively (see imaging.py), except
+    for LZW rasters, which R reads much faster.
+    Otherwise R plots them, using the vector or raster kept in the R
+    session by the rasterization (see R/configurator.R) if this is the same
+    session, or else reading it again from its file.
+    '''
+    plotfile = ""
+    native = image["engine"] == "Python" and image["format"][0:3] in imaging.nativeFormats() and \
+             (kind == "vector" or (raster["rformat"] == "GTiff" and "LZW" not in raster["roptions"]))
+    try:
+        if native:
+            plotfile = os.tempnam(workdir)
+            if kind == "vector":
+                imaging.renderVector(raster["vectorfile"], plotfile, image["format"][0:3])
+            else:
+                imaging.renderRaster(raster["rasterfile"], plotfile, image["format"][0:3])
+        else:
+            imageformat = ImageFormatTable[image["format"][0:3]]
+            with rpool.pool.connection(job_key) as R:
+                # TODO: Include basic plot parameters (e.g title of what we're plotting)
+                R.r.plotformat = imageformat["R-device"] # Select R image output device
+                if kind == "vector":
+                    R.r.plotfile = raster["vectorfile"]
+                    R.r.outfile = plotfile = os.tempnam(workdir)
+                    R.r('plotfunc(vectorfunc(plotfile,"input.file"),outfile,plotformat)',void=True)
+                else:
+                    # Use the RasterFormatTable format to load the to.plot dataset
+                    R.r.rasterfile = raster["rasterfile"]
+                    R.r.rasterformat = raster["rformat"]
+                    R.r.outfile = plotfile = os.tempnam(workdir)
+                    R.r('plotfunc(loadfunc(rasterfile,rasterformat,"rsa"),outfile,plotformat)',void=True)
+    except Exception as e:
+        logger.debug(str(e))
+        client.updateStatus('Imaging failure(%s): %s'%(kind,e))
+        if native and plotfile and os.path.exists(plotfile):
+            os.unlink(plotfile)
+        return "", False
+    return plotfile, native
+
+def thumbnailStage(raster, client, logger, workdir=None):
+    '''
+    Draw a small PNG image of the geoTIFF raster (from its smallest
+    overview, if it has them) in workdir (if given), returning the name of
+    the file, or "" if that failed
+    '''
+    thumbfile = os.tempnam(workdir)
+    try:
+        imaging.renderRaster(raster["rasterfile"], thumbfile, "PNG", imaging.ThumbnailSize)
+    except Exception as e:
+        logger.debug(str(e))
+        client.updateStatus('Thumbnail failure: '+str(e))
+        if os.path.exists(thumbfile):
+            os.unlink(thumbfile)
+        return ""
+    return thumbfile
+
+def publishResults(parameters, done, computation, config_summary, cache_key, job_key, stages, client, logger):
+    '''
+    Assemble the result files of a job from its parameters and the results
+    of its stages (done, a dictionary of stage name -> result), send them to
+    the NMTK server, cache them if every stage succeeded, and remove the
+    temporary files.  computation is the (file name, data or open file, MIME
+    type) of the computation results, if any, and config_summary the
+    summary.csv so far (the stage measurements are added to it).
+    '''
+    raster = parameters["raster"]
+    image = parameters["image"]
+    imageformat = ImageFormatTable[image["format"][0:3]]
+
+    # Results are only cached if every stage went smoothly
+    cacheable = True
+    pytempfiles = list(done.get("rasterize", []))
+    image["vectorplotfile"], vector_native = done.get("vector image", ("", False))
+    image["rasterplotfile"], raster_native = done.get("raster image", ("", False))
+    raster["thumbnailfile"] = done.get("thumbnail", "")
+    if (image["vector"] and not image["vectorplotfile"]) or \
+       (image["raster"] and not image["rasterplotfile"]) or \
+       (raster["thumbnail"] and not raster["thumbnailfile"]):
+        cacheable = False
+
+    ###################################
+    # Prepare results
+    stages.begin("results")
+    outfiles = {}
+    main_result = "summary"
+    comp_result = "computations"
+    vector_input = "vectorinput"
+    raster_file = "rasterfile"
+    vector_plot = "vectorplotfile"
+    raster_plot = "rasterplotfile"
+    raster_thumbnail = "rasterthumbnail"
+
+    # Result files are a dictionary with a key (the multi-part POST slug),
+    # plus a 3-tuple consisting of the recommended file name, the file data,
+    # and a MIME type.  Files on disk are handed over as open files rather
+    # than read into memory here, so the upload can read them a piece at a
+    # time; they are closed (and temporary ones removed) once the results
+    # have been sent.
+    openfiles = []
+    if computation:
+        if hasattr(computation[1], "read"):
+            openfiles.append(computation[1])
+        outfiles[comp_result] = computation
+
+    # Temporary files written by R, which R must remove (see below)
+    rtempfiles = []
+
+    if raster["returnvector"]:
+        try:
+            vecbase = open(raster["vectorfile"],"rb")
+            openfiles.append(vecbase)
+            outfiles[vector_input] = ( "vectorbase.geojson", vecbase, "application/json" )
+            client.updateStatus('Returning input vector file as geojson')
+        except Exception as e:
+            logger.debug(str(e))
+            client.updateStatus('Return vector failure: '+str(e))
+            cacheable = False
+    if image["vectorplotfile"]:
+        try:
+            vecimg = open(image["vectorplotfile"],"rb")
+            openfiles.append(vecimg)
+            outfiles[vector_plot] = ( 'vectorplot.%s'%(imageformat["extension"],), vecimg, imageformat["mimetype"] )
+            if vector_native:
+                pytempfiles.append(image["vectorplotfile"])
+            else:
+                rtempfiles.append(("vector", image["vectorplotfile"]))
+        except Exception as e:
+            logger.debug(str(e))
+            client.updateStatus("Preparing vector image output file failed: "+str(e))
+            cacheable = False
+    if raster["returnraster"]: # if we are expected to return a raster
+        try:
+            rasterfile = open(raster["rasterfile"],"rb")
+            openfiles.append(rasterfile)
+            outfiles[raster_file] = ( raster["displayname"], rasterfile, raster["mimetype"] )
+        except Exception as e:
+            logger.debug(str(e))
+            client.updateStatus("Preparing raw raster output file failed: "+str(e))
+            cacheable = False
+    if raster["thumbnailfile"]:
+        pytempfiles.append(raster["thumbnailfile"])
+        try:
+            thumbnail = open(raster["thumbnailfile"],"rb")
+            openfiles.append(thumbnail)
+            outfiles[raster_thumbnail] = ( 'rasterthumbnail.png', thumbnail, 'image/png' )
+        except Exception as e:
+            logger.debug(str(e))
+            client.updateStatus("Preparing raster thumbnail file failed: "+str(e))
+            cacheable = False
+    if raster["do"] and raster["rasterfile"] not in pytempfiles: # clean up the temporary rasterization file (may have done this without return raw file)
+        rtempfiles.append(("raster", raster["rasterfile"]))
+    if image["rasterplotfile"]:
+        try:
+            rstimg = open(image["rasterplotfile"],"rb")
+            openfiles.append(rstimg)
+            outfiles[raster_plot] = ( 'rasterplot.%s'%(imageformat["extension"],), rstimg, imageformat["mimetype"] )
+            if raster_native:
+                pytempfiles.append(image["rasterplotfile"])
+            else:
+                rtempfiles.append(("raster", image["rasterplotfile"]))
+        except Exception as e:
+            logger.debug(str(e))
+            client.updateStatus("Preparing raster image output file failed: "+str(e))
+            cacheable = False
+
+    # The summary is completed with the measurements of the stages so
+    # far (the upload is only logged); it is cached without them
+    stages.end()
+    cached_summary = config_summary.getvalue()
+    dw = csv.DictWriter(config_summary, fieldnames=("Description","Value"), extrasaction='ignore')
+    dw.writerows(summaryMeasures(stages, False))
+    del dw
+    outfiles[main_result] = ( 'summary.csv', config_summary.getvalue(), 'text/csv' )
+
+    stages.begin("upload")
+    try:
+        if outfiles and cacheable:
+            try:
+                job_cache = resultcache.FileCache(cacheDirectory("jobs"), ResultCacheBytes)
+                job_cache.put(cache_key,
+                              dict( (slug, cached_summary if slug == main_result else data)
+                                    for slug, (displayname, data, mimetype) in outfiles.iteritems() ),
+                              { "result_file" : main_result,
+                                "files" : dict( (slug, (displayname, mimetype))
+                                                for slug, (displayname, data, mimetype) in outfiles.iteritems() ) })
+            except Exception as e:
+                logger.debug("Caching results failed: "+str(e))
+
+        if outfiles:
+            client.updateResults(result_field=None,         # Default field to thematize in result_file
+                                 units=None,                # Text legend describing the units of 'result_field'
+                                 result_file=main_result,   # Supply the file 'key' (see outfiles above)
+                                 files=outfiles             # Dictionary of tuples providing result files
+                             )
+    finally:
+        for openfile in openfiles:
+            openfile.close()
+        if rtempfiles:
+            try:
+                with rpool.pool.connection(job_key) as R:
+                    for filetype, rtemp in rtempfiles:
+                        logger.debug("Removing temporary %s file: %s"%(filetype,rtemp))
+                        R.r.unlink(rtemp) # Get R to unlink the temporary file so we have permission
+            except Exception as e:
+                logger.debug("Removing temporary files failed: "+str(e))
+        for pytemp in pytempfiles:
+            try:
+                os.unlink(pytemp)
+            except OSError as e:
+                logger.debug(str(e))
+    stages.end()
+
 
 @task(ignore_result=False)
 def performModel(input_files,
@@ -64,71 +1055,85 @@ def performModel(input_files,
     # execution.  With luck, the tool server will also do periodic garbage
     # collection on tools that don't pick up after themselves.
 
-    # Prepare a connection to R
-    R = None
+    # Connections to R come from the worker's pool, one per stage; this key
+    # lets the pool return the same R workspace to later stages of the job.
+    # (Random, as uuid4 would be, without the cost of importing uuid.)
+    job_key = os.urandom(16).encode("hex")
+
+    # Time and measure each stage of the job (see instrument.py); the results
+    # are logged, and added to the summary.csv result file
+    stages = instrument.StageTimer(logger, job_key)
+
+    # Status updates are queued and sent in the background, so the job
+    # doesn't wait on the NMTK server; they are all sent before the results.
+    # (The stage tasks of a staged job are each given the client itself.)
+    nmtk_client = client
+    client = statusqueue.StatusSender(client, StatusWindow, StatusInterval, logger)
+
+    # The work directory of a staged job, which its stage tasks remove when
+    # they are done (or this task, if it fails before starting them)
+    workdir = None
 
     with Config.Job(input_files,tool_config) as job:
         
         try:
+            # Check the parameters against the tool configuration (see
+            # validation.py) before doing anything else, so an invalid job
+            # fails before it reads any file or connects to R.  Every
+            # parameter is present in job_parameters, with its default if it
+            # wasn't given.
+            stages.begin("validate")
+            job_parameters = validation.validatorFor(subtool_name or None).validate(tool_config)
+            status_interval = statusInterval(job_parameters)
+            client.setMinInterval(status_interval)
+            raster_size = job_parameters['rasterization_params']
+            if raster_size['dorasterize'] and not all(isinstance(raster_size[d], (int, long)) and raster_size[d] >= 1
+                                                      for d in ('raster_x', 'raster_y')):
+                raise validation.ParameterError(["The raster size (%s by %s cells) must be whole numbers of at least 1"%(
+                                                 raster_size['raster_x'], raster_size['raster_y'])])
+
             # Initialize the job setup (cant do in __init__ as we would need to
             # try too hard)
+            stages.begin("setup")
             job.setup()
 
             # Set up a master directory of parameters
+            stages.begin("parameters")
             parameters = {}
-            compute = parameters["compute"] = {}
             raster = parameters["raster"] = {}
             image = parameters["image"] = {}
 
             ########################################
             # Computation (Python/R)
-            compute_factors = job.getParameters('computation_params')
-            logger.debug(compute_factors)
-
-            #   Determine specific computational engines to use, if any
-            computetype    = compute["type"] = compute_factors.get('computetype',"None")
-
-            #   Notify the user via a status update
-            if computetype != 'None':
-                compute_R      = compute["with_R"] = computetype in ['R','Both']
-                compute_Python = compute["with_Python"] = computetype in ['Python','Both']
-
-                if compute_R or compute_Python:
-                    computemsg = "Computation will occur using"
-                    if compute_R:
-                        computemsg += " R"
-                        if compute_Python:
-                            computemsg += " and"
-                    if compute_Python:
-                        computemsg += " Python"
-                else:
-                    computemsg = "Computation will not occur"
-
-                #   Determine parameter; default is to square it same as /tool_config
-                compute["power"] = compute_factors.get('raisetopower',2)
-
+            compute, computemsg = computeParameters(job_parameters)
+            parameters["compute"] = compute
+            logger.debug(compute)
+            compute_R = compute.get("with_R", False)
+            compute_Python = compute.get("with_Python", False)
+            if compute_R or compute_Python:
                 #   Determine input (file/constant data) / we'll iterate later
                 compute_file = job.getFeatures('computation')
-
-                #   Determine what to return (result file)
-                compute_output = job.getParameters('computation_output')
-                compute["PythonName"] = compute_output.get('python_result','PowerOfPython')
-                compute["RName"] = compute_output.get('r_result','PowerOfR')
-            else:
-                computemsg = "Computation was not requested."
+                compute["fields"], compute["constants"] = computeFields(job)
 
             client.updateStatus(computemsg)
 
             ########################################
             # Rasterization (desired, input file provided, default to use instead)
-            raster_factors = job.getParameters('rasterization_params')
+            raster_factors = job_parameters['rasterization_params']
 
             # Set up the default files
             default_vector_name = os.path.join(settings.STATIC_ROOT, "Configurator/Vector_Test.geojson")
             default_raster_file = os.path.join(settings.STATIC_ROOT, "Configurator/Raster_Test.tif")
 
             #   Check if rasterization was requested
-            raster["do"] = raster_factors.get('dorasterize',0)
+            raster["do"] = raster_factors['dorasterize']
+
+            #   Rasterize with R, or with the native Python engine (see rasterize.py)
+            raster["engine"] = raster_factors['rasterengine']
+
+            #   Raster size, in cells
+            raster["x_dim"] = raster_factors['raster_x']
+            raster["y_dim"] = raster_factors['raster_y']
 
             # Get the filename to rasterize, substituting in a default if no file is
             # provided.  We won't load the file data since we're just going to hand
@@ -152,39 +1157,50 @@ def performModel(input_files,
                 raster["value"] = raster_value_set.get('rastervalue', 1)
             else:
                 raster["value"] = 1
-            raster["x_dim"] = raster_value_set.get('raster_x',300)
-            raster["y_dim"] = raster_value_set.get('raster_y',300)
             # raster["proportional"] = raster_value_set.get('proportional',0)
             # raster["smoothing"] = raster_value_set.get('smoothing',0)
 
             #   Set output format (Rdata-RDS, Erdas IMAGINE, geoTIFF)
-            raster_output = job.getParameters('rasterization_output')
-            raster["returnvector"] = raster_output.get('return_vector',0)
-            raster["format"] = raster_output.get('return_raster',"geoTIFF")
+            raster_output = job_parameters['rasterization_output']
+            raster["returnvector"] = raster_output['return_vector']
+            raster["format"] = raster_output['return_raster']
             rasterformat = RasterFormatTable.get(raster["format"],{})
-            if not rasterformat:  # Did not request return of raster
-                raster["returnraster"] = 0
-                msg = "Invalid raster format %s"%(raster["format"],)
-                client.UpdateStatus(msg)
-                raster["rasterfile"] = ""
-                raster["mimetype"] = ""
-                raster["displayname"] = ""
-                raster["savefunc"] = ""
-                raster["loadfunc"] = ""
-            else:
-                raster["returnraster"] = 1
-                rasterbasename = raster_output.get('raster_basename','raster')
-                if not raster["do"]:
-                    raster["format"] = "geoTIFF"
-                    rasterformat = RasterFormatTable.get(raster["format"],{})
+            raster["returnraster"] = 1 if rasterformat else 0
+            if not rasterformat:  # Did not request return of raster ("None")
+                client.updateStatus("No raster will be returned.")
+                # The raster is still made (for the raster image, if any),
+                # in a temporary file that is removed with the others
+                raster["format"] = UnreturnedRasterFormat
+            if not raster["do"]:
+                raster["format"] = "geoTIFF"
+            rasterformat = RasterFormatTable[raster["format"]]
+            if raster["do"]:
                 raster["rasterfile"] = os.tempnam()+rasterformat["extension"]
-                raster["mimetype"] = rasterformat["mimetype"]
-                raster["displayname"] = rasterbasename + rasterformat["extension"]     # The name to offer when the raw raster is sent back
-                if raster["do"]:
-                    raster["savefunc"] = rasterformat["save"]%(raster["rasterfile"],)  # R Function to save a dataset to rastername in selected format
-                else:
-                    raster["savefunc"] = "savefunc<-function(obj){invisible(0)}"       # don't save over default file (shouldn't call, but just in case!)
-                raster["loadfunc"] = rasterformat["load"]%(raster["rasterfile"],)      # R Function to load a raster for plotting
+            else:
+                raster["rasterfile"] = default_raster_file  # never saved over, only returned or plotted
+            raster["mimetype"] = rasterformat["mimetype"]
+            raster["displayname"] = raster_output['raster_basename'] + rasterformat["extension"]     # The name to offer when the raw raster is sent back
+            raster["rformat"] = rasterformat["R-format"]   # Format for the R savefunc/loadfunc
+            raster["roptions"] = rasterformat.get("R-options","")
+            raster["writer"] = rasterformat.get("writer")  # Native writer options, if any
+
+            #   Reduced-resolution overviews can be stored in the raster (by
+            #   the native writer), for quicker display, and a thumbnail
+            #   image of a returned geoTIFF sent along with it (but not of
+            #   an LZW one, which only R reads quickly; see imageStage).
+            #   When the raster isn't written natively, the overviews are
+            #   dropped (so they don't count towards the cache keys) and the
+            #   job is told so.
+            overviews = raster_output['raster_overviews']
+            raster["overviews"] = overviews and raster["do"] and raster["engine"] == "Python" and raster["writer"] is not None
+            raster["thumbnail"] = overviews and raster["returnraster"] and raster["rformat"] == "GTiff" and \
+                                  "LZW" not in raster["roptions"]
+            if overviews and not raster["overviews"]:
+                client.updateStatus("Raster overviews are ignored: they are only made when the Python rasterization "
+                                    "engine writes the raster itself, in the tiled DEFLATE geoTIFF format." +
+                                    (" The thumbnail is still made." if raster["thumbnail"] else ""))
+            if overviews and raster["returnraster"] and not raster["thumbnail"]:
+                client.updateStatus("No raster thumbnail is made for the %s format."%(raster["format"],))
 
             if raster["do"]: # don't bother setting up unless rasterization requested
                 client.updateStatus('Rasterization successfully configured.')
@@ -193,18 +1209,18 @@ def performModel(input_files,
 
             ########################################
             # Image Generation (desired, output format)
-            image_selection = job.getParameters('imaging_params')
-            image["vector"] = image_selection.get('imagevector',0)
-            image["raster"] = image_selection.get('imageraster',0)
+            image_selection = job_parameters['imaging_params']
+            image["vector"] = image_selection['imagevector']
+            image["raster"] = image_selection['imageraster']
 
-            image_output = job.getParameters('image_output')
+            #   Plot with R, or draw natively in Python (see imaging.py)
+            image["engine"] = image_selection['imageengine']
+
+            #   The format is one of the choices in the tool configuration
+            #   (e.g. "PDF (Download Only)", which validation has checked);
+            #   ImageFormatTable knows it by its first three letters
+            image_output = job_parameters['image_output']
             image["format"] = image_output["imageformat"]
-            imageformat = ImageFormatTable.get(image["format"][0:3],{})
-            if not imageformat:
-                # Unknown format, don't do images
-                image["vector"] = image["raster"] = 0
-                msg = "Invalid image format: %s (%s)"%(image["format"],image["format"][0:3])
-                client.updateStatus(msg)
             if image["vector"] or image["raster"]:
                 client.updateStatus("Imaging successfully configured.")
             else:
@@ -212,9 +1228,69 @@ def performModel(input_files,
 
             client.updateStatus('Parameter & data file validation complete.')
 
+            ###################################
+            # Result cache
+            stages.begin("cache")
+            # If an identical earlier job (same input files, same parameters)
+            # has already produced results, just return those.
+            job_cache = resultcache.FileCache(cacheDirectory("jobs"), ResultCacheBytes)
+            # Only the inputs the requested results depend on are hashed
+            checksums = {}
+            if raster["do"] or raster["returnvector"] or image["vector"]:
+                checksums["rasterize"] = resultcache.fileSHA1(raster["vectorfile"])
+            if compute_R or compute_Python:
+                checksums["computation"] = resultcache.fileSHA1(job.datafile('computation'))
+            cache_key = jobCacheKey(parameters, checksums)
+            cached = openCachedResults(job_cache.get(cache_key))
+            if cached:
+                cached_result, cached_outfiles = cached
+                client.updateStatus('Returning results cached from an identical earlier job.')
+                try:
+                    # The cached summary is completed with this job's own
+                    # measurements, as publishResults does
+                    stages.end()
+                    displayname, data, mimetype = cached_outfiles[cached_result]
+                    summary = StringIO.StringIO()
+                    summary.write(data.read())
+                    dw = csv.DictWriter(summary, fieldnames=("Description","Value"), extrasaction='ignore')
+                    dw.writerows(summaryMeasures(stages, True))
+                    del dw
+                    files = dict(cached_outfiles)
+                    files[cached_result] = ( displayname, summary.getvalue(), mimetype )
+                    stages.begin("upload")
+                    client.updateResults(result_field=None,
+                                         units=None,
+                                         result_file=cached_result,
+                                         files=files
+                                     )
+                finally:
+                    for displayname, data, mimetype in cached_outfiles.itervalues():
+                        data.close()
+                stages.end()
+                return
+
             ###################################
             # Now perform the requested actions
 
+            # A staged job's files are kept in a work directory of its own
+            # that each of its stage tasks can reach, wherever it runs (see
+            # startStages), including copies of its input files
+            if subtool_name in StagedTools:
+                workdir = tempfile.mkdtemp(prefix="job-", dir=workDirectory())
+                os.chmod(workdir, getattr(settings, 'CONFIGURATOR_WORK_DIR_MODE', WorkDirectoryMode))
+                moves = {}
+                for namespace in ("computation", "rasterize"):
+                    try:
+                        source = job.datafile(namespace)
+                    except Exception:
+                        continue
+                    moves[source] = os.path.join(workdir, namespace + "-" + os.path.basename(source))
+                    linkOrCopy(source, moves[source])
+                input_files = relocated(input_files, moves)
+                raster["vectorfile"] = moves.get(raster["vectorfile"], raster["vectorfile"])
+                if raster["do"] and raster["rasterfile"]:
+                    raster["rasterfile"] = os.path.join(workdir, "raster" + rasterformat["extension"])
+
             ###################################
             # Configuration Summary
             # Assemble an output file of what was configured (essentially for debugging)
@@ -233,246 +1309,385 @@ def performModel(input_files,
                         )
             del dw
 
+            if workdir:
+                stages.end()
+                work = { "job_key" : job_key,
+                         "input_files" : input_files,
+                         "tool_config" : tool_config,
+                         "parameters" : parameters,
+                         "checksums" : checksums,
+                         "cache_key" : cache_key,
+                         "summary" : config_summary.getvalue(),
+                         "workdir" : workdir,
+                         "status_interval" : status_interval,
+                         "stages" : stages.stages }
+                client.close()
+                startStages(work, nmtk_client)
+                return
 
             ###################################
-            # Computation
-
-            # Remember that all parameters, regardless of their stated type, arrive
-            # in the tool as string representations (the promise is just that the
-            # string will probably convert successfully to the tool_config type).
-            # Thus all the computation code should perform idempotent conversions...
-            if compute_Python:
-                pyPower = decimal.Decimal(str(compute["power"]))
-            if compute_R:
-                if not R:
-                    R = pyRserve.connect()
+            # Computation, rasterization and imaging
+            # Stages that don't depend on one another run at the same time
+            # (see schedule.py), each with its own R connection; the raster
+            # image waits for the rasterization.  Everything has finished
+            # before the results are assembled.
+            stages.end()
+            #
+            # The rasterization and the images that follow it ask the pool
+            # for the R session kept under raster_session, so the images can
+            # use the raster (and, when R rasterizes, the vector) still in
+            # its workspace rather than reading the files again.  Each image
+            # falls back to reading the file if it gets another session.
+            graph = schedule.StageGraph(stages)
+            raster_session = (job_key, "raster")
+            python_pool = None
+            if compute_R or compute_Python:
+                # The process pool is started here, before the stages'
+                # threads are (see computePool)
+                python_pool = computePool(compute, client)
+                graph.add("compute", lambda: computeStage(compute_file, job.datafile('computation'), compute,
+                                                          python_pool, job_key, client, logger))
+            if raster["do"]:
+                graph.add("rasterize", lambda: rasterizeStage(raster, checksums["rasterize"], raster_session, client, logger))
+            if image["raster"]:
+                graph.add("raster image", lambda: imageStage("raster", raster, image, raster_session, client, logger),
+                          after=["rasterize"] if raster["do"] else [])
+            if raster["thumbnail"]:
+                graph.add("thumbnail", lambda: thumbnailStage(raster, client, logger),
+                          after=["rasterize"] if raster["do"] else [])
+            if image["vector"]:
+                if raster["do"] and raster["engine"] == "R" and image["engine"] == "R":
+                    # Follow the rasterization (and its image), which has
+                    # already read the vector
+                    graph.add("vector image", lambda: imageStage("vector", raster, image, raster_session, client, logger),
+                              after=["raster image"] if image["raster"] else ["rasterize"])
                 else:
-                    R.connect()
-                R.r.rpower = compute["power"] # R.r.r...
-                # The JSON parser (used in displaying NMTK results) chokes on a NaN
-                # returned directly from R because it doesn't recognize an unquoted
-                # NaN as numeric and sees it as a string without quotes; We'll
-                # account for that in the R function and return a string
-                R.r("""
-                # Fun with R closure magic: convert the power from string to number
-                # once then embed that in a function and return the function, which
-                # we promptly call with the power to make the actual computational
-                # function.  Note parenthetical priorities...
-
-                compute <- (function(rp) {
-                    rpower <- as.numeric(rp)
-                    function(value) {
-                        result <- as.numeric(value) ** rpower
-                        if (is.nan(result)||is.na(result)) result<-"Nan-R"
-                        result
-                    }
-                })(rpower)
-                # Later, just call compute(value)
-                """, void=True)
-
-            for row in compute_file: # Loop over the rows in the input file
-                for field, value in row.iteritems():
-                    if compute_Python:
-                        try:
-                            pyValue = decimal.Decimal(str(value))
-                        except:
-                            pyValue = decimal.Decimal.from_float(float('nan'))
-                        if not pyValue.is_nan():
-                            pyResult = pyValue ** pyPower
-                        else:
-                            pyResult = "NaN-Python"
-                        compute_file.addResult(compute["PythonName"]+"_"+field, pyResult)    
-                    if compute_R:
-                        Rresult = R.r.compute(value)
-                        logger.debug("Computed R result for field %s, Result %s of value %s ** power %s"%(field, Rresult,value,R.r.rpower))
-                        compute_file.addResult(compute["RName"]+"_"+field,Rresult)    
-            if R:
-                R.close()
-            
-            client.updateStatus('Done with computations')
+                    graph.add("vector image", lambda: imageStage("vector", raster, image, job_key, client, logger))
+            try:
+                done = graph.run(StageWorkers)
+            finally:
+                if python_pool:
+                    python_pool.close()
 
-            ###################################
-            # Rasterization
+            computation = None
+            if compute_R or compute_Python:
+                computation = computationResult(compute_file, done.get("compute"))
+            publishResults(parameters, done, computation, config_summary, cache_key, job_key, stages, client, logger)
+
+        except Exception as e:
+            stages.end(failed=True)
+            msg = 'Job failed.'
+            logger.exception(msg)
+            logger.exception(str(e))
+            job.fail(msg)
+            job.fail(str(e))
+            client.updateResults(payload={'errors': job.failures },
+                                 failure=True,
+                                 files={}
+                                )
+            if workdir:
+                shutil.rmtree(workdir, ignore_errors=True)
 
-            # If requested, take the input vector (either a supplied or default
-            # file) and pass it through the R rasterization
-            # If NOT requested, but imaging of a raster was presented, just
-            # use the default raster from the world of static data
+@task(ignore_result=False)
+def performBatch(batch,
+                 tool_config,
+                 client,
+                 subtool_name=False):
+    '''
+    batch is a list of input_files (as for performModel), one for each item
+    tool_config is the "header" part of the input, shared by every item
+    client is an object of type NMTK_apps.helpers.server_api.NMTKClient
+    subtool_name is provided if the tool manages multiple configurations
 
-            if raster["do"]:
-                if not R:
-                    R = pyRserve.connect()
-                else:
-                    R.connect()
-                R.r.vectorfile = raster["vectorfile"] # File to rasterize
-                # Note that output file is built into "savefunc"
-                R.r.xdim = raster["x_dim"]  # Desired raster resolution, x and y
-                R.r.ydim = raster["y_dim"]
-                R.r.rastervalue = raster["value"] # Value for raster cells,  either text/fieldname or numeric value
-                R.r(raster["savefunc"]) # Load the function to save the raster in desired format
-                # Actions:
-                #   Load vector file
-                #   Create extent from the file
-                #   Create a blank raster with the right resolution (use default values)
-                #   Rasterize the input file; raster.field can flexibly be a field name or a value
-                #   Write it out in a suitable format for later plotting
-                R.r("""
-                    require(rgdal)
-                    require(sp)
-                    require(raster)
-                    input.file <- readOGR(vectorfile,layer="OGRGeoJSON")
-                    e <- extent(input.file)
-                    t <- raster(e,nrows=ydim,ncols=ydim)
-                    rsa <- rasterize(input.file,t,field=rastervalue)
-                    savefunc(rsa)
-                    """, void=True)
-                if R:
-                    R.close()
+    Computes each item's computation input with the same parameters, which
+    are checked and set up once for the whole batch, using one R session
+    (and one pool of Python processes, if the computation is parallel).
+    Rasterization and imaging are not done for batches.  The results are one
+    computation file per item that succeeded plus a batch.csv listing how
+    each item went; a failed item doesn't stop the others.  Returns a list
+    of { "item", "failed", "error" } for the items.
+    '''
+    logger=performBatch.get_logger()
+    logger.debug("batch of %d: %s"%(len(batch),batch))
+    logger.debug("tool_config\n%s\n"%(tool_config,))
 
-            ###################################
-            # Imaging
+    # One key for the whole batch, so every item uses the same R session
+    job_key = os.urandom(16).encode("hex")
+    stages = instrument.StageTimer(logger, job_key)
+    client = statusqueue.StatusSender(client, StatusWindow, StatusInterval, logger)
 
-            # If requested, take either the vector, the rasterized result or both
-            # and pass them through R
+    try:
+        stages.begin("validate")
+        job_parameters = validation.validatorFor(subtool_name or None).validate(tool_config)
+        client.setMinInterval(statusInterval(job_parameters))
 
-            # Image file is raster["vectorfile"]
-            image["vectorplotfile"] = ""
-            image["rasterplotfile"] = ""
-            if image["vector"] or image["raster"]:
-                if not R:
-                    R = pyRserve.connect()
-                else:
-                    R.connect()
-                # TODO: Include basic plot parameters (e.g title of what we're plotting)
-                R.r.plotformat = imageformat["R-device"] # Select R image output device
-                R.r("""
-                plotfunc <- function(to.plot, outfile) {
-                    plotdev <- get(plotformat)
-                    plotdev(file=outfile)
-                    plot(to.plot)
-                    dev.off()
-                }
-                """,void=True)
-
-                if image["vector"]:
-                    try:
-                        R.r.plotfile = raster["vectorfile"]
-                        R.r.outfile = image["vectorplotfile"] = os.tempnam()
-                        R.r("""
-                        library(sp)
-                        library(rgdal)
-                        to.plot <- readOGR(plotfile,layer="OGRGeoJSON")
-                        plotfunc(to.plot,outfile)
-                        """,void=True)
-                    except Exception as e:
-                        logger.debug(str(e))
-                        client.updateStatus('Imaging failure(vector): '+str(e))
+        stages.begin("parameters")
+        compute, computemsg = computeParameters(job_parameters)
+        logger.debug(compute)
+        if not (compute.get("with_R") or compute.get("with_Python")):
+            raise validation.ParameterError(["A batch must request a computation (computetype is %s)"%(compute["type"],)])
+        client.updateStatus(computemsg)
+        if job_parameters['rasterization_params']['dorasterize'] or \
+           job_parameters['imaging_params']['imagevector'] or job_parameters['imaging_params']['imageraster']:
+            client.updateStatus("Rasterization and imaging are not done for batches.")
 
-                if image["raster"]:
+        # Each item is set up and computed in turn, with the shared
+        # parameters, connection and process pool
+        stages.begin("compute")
+        items = []
+        outfiles = {}
+        openfiles = []
+        python_pool = computePool(compute, client)
+        try:
+            with optionalConnection(compute["with_R"], job_key) as R:
+                for index, input_files in enumerate(batch):
+                    item = { "item" : index + 1, "failed" : False, "error" : "" }
+                    items.append(item)
                     try:
-                        # Change to use RasterFormatTable Load function to obtain the to.plot dataset
-                        R.r(raster["loadfunc"]) # install load function for raster in requested format
-                        R.r.outfile = image["rasterplotfile"] = os.tempnam()
-                        R.r("""
-                        library(raster)
-                        to.plot <- loadfunc()
-                        plotfunc(to.plot,outfile)
-                        """,void=True)
+                        with Config.Job(input_files,tool_config) as job:
+                            job.setup()
+                            compute_file = job.getFeatures('computation')
+                            item_compute = dict(compute)
+                            item_compute["fields"], item_compute["constants"] = computeFields(job)
+                            compute_spool = computeFile(compute_file, job.datafile('computation'), item_compute,
+                                                        R, python_pool, logger)
+                            if compute_spool:
+                                openfiles.append(compute_spool)
+                            outfiles["computations-%d"%(item["item"],)] = \
+                                computationResult(compute_file, compute_spool, "computation-%d"%(item["item"],))
                     except Exception as e:
-                        logger.debug(str(e))
-                        client.updateStatus('Imaging failure(raster): '+str(e))
-                if R:
-                    R.close()
-
-            ###################################
-            # Prepare results
-            outfiles = {}
-            main_result = "summary"
-            comp_result = "computations"
-            vector_input = "vectorinput"
-            raster_file = "rasterfile"
-            vector_plot = "vectorplotfile"
-            raster_plot = "rasterplotfile"
-
-            # Result files are a dictionary with a key (the multi-part POST slug),
-            # plus a 3-tuple consisting of the recommended file name, the file data,
-            # and a MIME type
-            outfiles[main_result] = ( 'summary.csv', config_summary.getvalue(), 'text/csv' )
-            if compute_R or compute_Python:
-                outfiles[comp_result] = ( 'computation.%s'%(compute_file.extension,), compute_file.getDataFile(), compute_file.content_type )
+                        logger.exception("Batch item %d failed"%(item["item"],))
+                        item["failed"] = True
+                        item["error"] = str(e)
+                    client.updateStatus("Computed %d of %d items"%(index + 1, len(batch)))
+        finally:
+            if python_pool:
+                python_pool.close()
 
-            if image["vectorplotfile"] or raster["do"] or image["rasterplotfile"]:
-                # There really should always be an "R" in this case
-                if not R:
-                    R = pyRserve.connect()
-                else:
-                    R.connect()
+        stages.begin("results")
+        failed = [ entry for entry in items if entry["failed"] ]
+        summary = StringIO.StringIO()
+        dw = csv.DictWriter(summary, fieldnames=("Item","Status","Error"), extrasaction='ignore')
+        dw.writeheader()
+        for item in items:
+            dw.writerow({ "Item" : item["item"], "Status" : "failed" if item["failed"] else "done",
+                          "Error" : item["error"] })
+        del dw
+        outfiles["batch"] = ( 'batch.csv', summary.getvalue(), 'text/csv' )
 
-            if raster["returnvector"]:
-                try:
-                    vecbase = open(raster["vectorfile"])
-                    outfiles[vector_input] = ( "vectorbase.geojson", vecbase.read(), "application/json" )
-                    client.updateStatus('Returning input vector file as geojson')
-                    vecbase.close()
-                except Exception as e:
-                    logger.debug(str(e))
-                    client.updateStatus('Return vector failure: '+str(e))
-            if image["vectorplotfile"]:
-                try:
-                    vecimg = open(image["vectorplotfile"],"rb")
-                    outfiles[vector_plot] = ( 'vectorplot.%s'%(imageformat["extension"],), vecimg.read(), imageformat["mimetype"] )
-                    vecimg.close()
-                    client.updateStatus("Removing temporary vector file: "+image["vectorplotfile"])
-                    R.r.unlink(image["vectorplotfile"]) # Get R to unlink the temporary file so we have permission
-                except Exception as e:
-                    logger.debug(str(e))
-                    client.updateStatus("Preparing vector image output file failed: "+str(e))
-            if raster["returnraster"]: # if we are expected to return a raster
-                try:
-                    rasterfile = open(raster["rasterfile"],"rb")
-                    outfiles[raster_file] = ( raster["displayname"], rasterfile.read(), raster["mimetype"] )
-                    rasterfile.close()
-                except Exception as e:
-                    logger.debug(str(e))
-                    client.updateStatus("Preparing raw raster output file failed: "+str(e))
-            if raster["do"]: # clean up the temporary rasterization file (may have done this without return raw file)
-                try:
-                    client.updateStatus("Removing temporary raster file: "+raster["rasterfile"])
-                    R.r.unlink(raster["rasterfile"]) # Get R to unlink the temporary file so we have permission
-                except Exception as e:
-                    logger.debug(str(e))
-                    client.updateStatus("Preparing raw raster output file failed: "+str(e))
-            if image["rasterplotfile"]:
-                try:
-                    rstimg = open(image["rasterplotfile"],"rb")
-                    outfiles[raster_plot] = ( 'rasterplot.%s'%(imageformat["extension"],), rstimg.read(), imageformat["mimetype"] )
-                    rstimg.close()
-                    client.updateStatus("Removing temporary raster file: "+image["rasterplotfile"])
-                    R.r.unlink(image["rasterplotfile"]) # Get R to unlink the temporary file so we have permission
-                except Exception as e:
-                    logger.debug(str(e))
-                    client.updateStatus("Preparing raster image output file failed: "+str(e))
-
-            if outfiles:
-                client.updateResults(result_field=None,         # Default field to thematize in result_file
-                                     units=None,                # Text legend describing the units of 'result_field'
-                                     result_file=main_result,   # Supply the file 'key' (see outfiles above)
-                                     files=outfiles             # Dictionary of tuples providing result files
+        stages.begin("upload")
+        try:
+            if len(failed) < len(items):
+                client.updateResults(result_field=None,
+                                     units=None,
+                                     result_file="batch",
+                                     files=outfiles
                                  )
-            if R:
-                R.close()
+            else:
+                client.updateResults(payload={'errors': [ 'Every item of the batch failed.' ] +
+                                                        [ "Item %d: %s"%(entry["item"],entry["error"]) for entry in failed ] },
+                                     failure=True,
+                                     files={}
+                                    )
+        finally:
+            for openfile in openfiles:
+                openfile.close()
+        stages.end()
+        return items
 
-        except Exception as e:
-            msg = 'Job failed.'
-            logger.exception(msg)
-            logger.exception(str(e))
-            job.fail(msg)
-            job.fail(str(e))
-            client.updateResults(payload={'errors': job.failures },
+    except Exception as e:
+        stages.end(failed=True)
+        msg = 'Batch failed.'
+        logger.exception(msg)
+        client.updateResults(payload={'errors': [ msg, str(e) ] },
+                             failure=True,
+                             files={}
+                            )
+        return [ { "item" : index + 1, "failed" : True, "error" : str(e) } for index in range(len(batch)) ]
+
+###################################
+# Staged jobs
+#
+# A job for one of the StagedTools is checked and set up by performModel as
+# usual, which then starts a task for each of its stages, passing each the
+# job's "work" (its parameters and work directory) and a dictionary of what
+# the stages before it have done:
+#
+#   compute ---------------------------------------\
+#   rasterize -> raster image -> thumbnail ---------+-> publish
+#   vector image ----------------------------------/
+#
+# The branches run at the same time (on whichever workers take them), and
+# publish runs when they have all finished, with what each branch did.  The
+# vector image follows the raster image (or the rasterization) when both are
+# done with R, as in performModel.
+
+def runStage(name, function, done, work, client, logger):
+    '''
+    Run function(client) as stage name of a staged job, adding its result to
+    a copy of done (what the stages before it have done, by stage name, plus
+    the "errors" so far and the "stages" measurements), which is returned.
+    The stage is skipped if one before it has failed.
+    '''
+    done = dict(done, errors=list(done.get("errors", [])), stages=list(done.get("stages", [])))
+    if done["errors"]:
+        return done
+    stages = instrument.StageTimer(logger, work["job_key"])
+    client = statusqueue.StatusSender(client, StatusWindow, work["status_interval"], logger)
+    try:
+        with stages.span(name):
+            done[name] = function(client)
+    except Exception as e:
+        logger.exception("Stage %s failed"%(name,))
+        done["errors"].append("%s: %s"%(name, e))
+    client.close()
+    done["stages"].extend(stages.stages)
+    return done
+
+def startStages(work, client):
+    '''
+    Start the stage tasks of a staged job, each on its stage's queue
+    '''
+    parameters = work["parameters"]
+    compute = parameters["compute"]
+    raster = parameters["raster"]
+    image = parameters["image"]
+
+    # Each branch is a list of (task, queue, arguments after done and work)
+    branches = []
+    if compute.get("with_R", False) or compute.get("with_Python", False):
+        branches.append([ (computeTask, "compute", ()) ])
+    raster_branch = []
+    if raster["do"]:
+        raster_branch.append((rasterizeTask, "rasterize", ()))
+    if image["raster"]:
+        raster_branch.append((imageTask, "image", ("raster",)))
+    if raster["thumbnail"]:
+        raster_branch.append((imageTask, "image", ("thumbnail",)))
+    if image["vector"]:
+        if raster["do"] and raster["engine"] == "R" and image["engine"] == "R":
+            raster_branch.append((imageTask, "image", ("vector",)))
+        else:
+            branches.append([ (imageTask, "image", ("vector",)) ])
+    if raster_branch:
+        branches.append(raster_branch)
+
+    # The first stage of a branch starts with nothing done; Celery passes
+    # each of the others what the stage before it did
+    header = []
+    for branch in branches:
+        signatures = [ task.s(*((() if position else ({},)) + (work, client) + args)).set(queue=stageQueue(queue))
+                       for position, (task, queue, args) in enumerate(branch) ]
+        header.append(chain(*signatures) if len(signatures) > 1 else signatures[0])
+    if not header:
+        return publishTask.apply_async(([], work, client), queue=stageQueue("publish"))
+    return chord(header)(publishTask.s(work, client).set(queue=stageQueue("publish")))
+
+@task(ignore_result=False)
+def computeTask(done, work, client):
+    '''
+    The compute stage of a staged job: computes the results into a file in
+    the work directory, passing on its (display name, path, MIME type)
+    '''
+    logger = computeTask.get_logger()
+    def compute(client):
+        with Config.Job(work["input_files"], work["tool_config"]) as job:
+            job.setup()
+            compute_file = job.getFeatures('computation')
+            python_pool = computePool(work["parameters"]["compute"], client)
+            try:
+                compute_spool = computeStage(compute_file, job.datafile('computation'), work["parameters"]["compute"],
+                                             python_pool, work["job_key"], client, logger)
+            finally:
+                if python_pool:
+                    python_pool.close()
+            try:
+                displayname, data, mimetype = computationResult(compute_file, compute_spool)
+                path = os.path.join(work["workdir"], displayname)
+                with open(path, "wb") as f:
+                    if hasattr(data, "read"):
+                        shutil.copyfileobj(data, f)
+                    else:
+                        f.write(data)
+            finally:
+                if compute_spool:
+                    compute_spool.close()
+        return displayname, path, mimetype
+    return runStage("compute", compute, done, work, client, logger)
+
+@task(ignore_result=False)
+def rasterizeTask(done, work, client):
+    '''
+    The rasterize stage of a staged job, writing the raster into the work
+    directory
+    '''
+    logger = rasterizeTask.get_logger()
+    raster = work["parameters"]["raster"]
+    return runStage("rasterize",
+                    lambda client: rasterizeStage(raster, work["checksums"]["rasterize"],
+                                                  (work["job_key"], "raster"), client, logger),
+                    done, work, client, logger)
+
+@task(ignore_result=False)
+def imageTask(done, work, client, kind):
+    '''
+    An imaging stage of a staged job: kind is "vector" or "raster" (see
+    imageStage), or "thumbnail" (see thumbnailStage), and the image is
+    written into the work directory
+    '''
+    logger = imageTask.get_logger()
+    raster = work["parameters"]["raster"]
+    image = work["parameters"]["image"]
+    if kind == "thumbnail":
+        return runStage("thumbnail", lambda client: thumbnailStage(raster, client, logger, work["workdir"]),
+                        done, work, client, logger)
+    # The rasterization's R session (if this worker has it) still holds
+    # the raster and, if R rasterized, the vector
+    session = work["job_key"]
+    if kind == "raster" or (raster["do"] and raster["engine"] == "R" and image["engine"] == "R"):
+        session = (session, "raster")
+    return runStage(kind + " image",
+                    lambda client: imageStage(kind, raster, image, session, client, logger, work["workdir"]),
+                    done, work, client, logger)
+
+@task(ignore_result=False)
+def publishTask(results, work, client):
+    '''
+    The last stage of a staged job: sends the results of the stages (results
+    is a list of what each branch did) to the NMTK server, as performModel
+    would, or their errors if any failed, then removes the work directory
+    '''
+    logger = publishTask.get_logger()
+    stages = instrument.StageTimer(logger, work["job_key"])
+    stages.extend(work["stages"])
+    client = statusqueue.StatusSender(client, StatusWindow, work["status_interval"], logger)
+    done = {}
+    errors = []
+    for result in results:
+        errors.extend(result.get("errors", []))
+        stages.extend(result.get("stages", []))
+        done.update( (name, value) for name, value in result.iteritems() if name not in ("errors", "stages") )
+    try:
+        if errors:
+            client.updateResults(payload={'errors': [ 'Job failed.' ] + errors },
                                  failure=True,
                                  files={}
                                 )
-
-    # Clean up R after all is done (harmless if R is None, cleans up
-    # connection to Rserve otherwise)
-    del R
+            return
+        computation = None
+        if done.get("compute"):
+            displayname, path, mimetype = done["compute"]
+            computation = ( displayname, open(path, "rb"), mimetype )
+        config_summary = StringIO.StringIO()
+        config_summary.write(work["summary"])
+        publishResults(work["parameters"], done, computation, config_summary, work["cache_key"],
+                       work["job_key"], stages, client, logger)
+    except Exception as e:
+        stages.end(failed=True)
+        logger.exception('Job failed.')
+        client.updateResults(payload={'errors': [ 'Job failed.', str(e) ] },
+                             failure=True,
+                             files={}
+                            )
+    finally:
+        shutil.rmtree(work["workdir"], ignore_errors=True)
@@ -42,9 +42,18 @@ tool application.  See the MN_tool sample tool for complete
 details.
 """
 
+import hashlib
+import json
+import os
+import tempfile
+
 # If this tool has no subtools, you can leave out the "tools"
-# list entirely (or just leave it empty as it is here)
-tools = []
+# list entirely (or just leave it empty).  This tool offers its configuration
+# twice: "tool_config" runs each job in a single task, and "staged_config"
+# runs each stage of a job (computation, rasterization, imaging, publishing
+# the results) as a separate task, so the stages can be given workers of
+# their own (see StagedTools in tasks.py).
+tools = [ "tool_config", "staged_config" ]
 
 # If tool_configs.py contains the generateToolConfiguration function,
 # that will be used preferentially to generate a Python dictionary
@@ -55,10 +64,94 @@ def generateToolConfiguration(tool,sub_tool=None):
     '''
     Simple function-based approach to returning a tool_config
     In this case, we just return the python dictionary that would
-    have been used to make tool_config.json
+    have been used to make tool_config.json (or staged_config.json)
     '''
+    if sub_tool in tools:
+        return globals()[sub_tool]
     return tool_config
 
+# The NMTK serialises the dictionaries that generateToolConfiguration returns
+# itself, so the only pre-serialised route to it is the file-based one: running
+# this file writes each configuration as JSON to the templates folder (see the
+# end of the file), for deployments that remove generateToolConfiguration.
+# Each template has the SHA-1 of its text stored next to it (<name>.json.sha1),
+# and refreshTemplates rewrites only the templates whose configurations no
+# longer match; in a deployment without generateToolConfiguration it runs
+# whenever the NMTK loads this file, so the templates can't go stale.
+TemplateDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates", "Configurator")
+
+def configurationNames():
+    '''
+    The names of the configuration dictionaries in this file, one per tool
+    or subtool
+    '''
+    return tools or ["tool_config"]
+
+def serialiseConfiguration(name):
+    '''
+    The JSON text of the named configuration, compact and with its keys
+    sorted so that the text (and its hash) only change with the content
+    '''
+    return json.dumps(globals()[name], sort_keys=True, separators=(',',':'))
+
+def templatePath(name):
+    '''
+    The file name of the named configuration's template
+    '''
+    return os.path.join(TemplateDirectory, "%s.json"%(name,))
+
+def writeFile(path, text):
+    '''
+    Write text to path in the templates folder (by way of a temporary file,
+    so a reader never sees a partial file)
+    '''
+    handle, temporary = tempfile.mkstemp(dir=TemplateDirectory, suffix=".tmp")
+    try:
+        with os.fdopen(handle, "wb") as f:
+            f.write(text)
+        os.chmod(temporary, 0o644)  # readable by the web server, like the other templates
+        os.rename(temporary, path)
+    except:
+        os.unlink(temporary)
+        raise
+
+def writeTemplate(name, text):
+    '''
+    Write the JSON text of a configuration to the templates folder, followed
+    by its SHA-1 (in <name>.json.sha1), returning the file name
+    '''
+    path = templatePath(name)
+    writeFile(path, text)
+    writeFile(path + ".sha1", hashlib.sha1(text).hexdigest() + "\n")
+    return path
+
+def templateIsCurrent(name, text):
+    '''
+    Whether the named configuration's template holds text, going by the
+    SHA-1 stored next to it
+    '''
+    try:
+        with open(templatePath(name) + ".sha1") as f:
+            stored = f.read().strip()
+    except IOError:
+        return False
+    return stored == hashlib.sha1(text).hexdigest() and os.path.isfile(templatePath(name))
+
+def refreshTemplates():
+    '''
+    Rewrite the templates of the configurations that have changed since they
+    were written, returning a list of (name, file name, JSON text, whether it
+    was rewritten)
+    '''
+    templates = []
+    for name in configurationNames():
+        text = serialiseConfiguration(name)
+        rewritten = not templateIsCurrent(name, text)
+        if rewritten:
+            writeTemplate(name, text)
+        templates.append((name, templatePath(name), text, rewritten))
+    return templates
+
 # The master configuration for this particular tool that works with
 # the implementation of the generateToolConfiguration function
 # is defined in the following Pdython dictionary.
@@ -280,7 +373,7 @@ of result fields or what result types they should expect.</li>
                 },
             },
             "image_output" : {
-                "image_format" : {
+                "imageformat" : {
                     "type" : "string",
                     "value": "PNG",
                 },
@@ -375,12 +468,36 @@ Parameters that control what will be done with the computation data.
               {
                   "description" : "Which computation engines will be used.",
                   "default" : "Python",
-                  "choices" : [ "Python","R","Both","None" ],
+                  "choices" : [ "Python","Python-vectorized","R","Both","None" ],
                   "required" : True,
                   "label" : "Computation Engines",
                   "type" : "string",
                   "name" : "computetype"
               },
+              {
+                  "description" : """
+Precision used by the Python-vectorized engine.  "Fast" computes in floating
+point (falling back to decimal math only for cells that overflow); "Exact" uses
+decimal math for every cell.
+""",
+                  "default" : "Fast",
+                  "choices" : [ "Fast","Exact" ],
+                  "required" : False,
+                  "label" : "Python Precision",
+                  "type" : "string",
+                  "name" : "computeprecision"
+              },
+              {
+                  "description" : """
+If true, large Python computations are spread across the processor cores of the
+tool server (small inputs are always computed in a single process).
+""",
+                  "default" : 0,
+                  "required" : False,
+                  "label" : "Parallel Python",
+                  "type" : "boolean",
+                  "name" : "parallel"
+              },
             ],
         },
         {
@@ -402,6 +519,19 @@ Parameters that control how rasterization will be performed.
                   "type" : "boolean",
                   "name" : "dorasterize"
               },
+              {
+                  "description" : """
+The engine used to rasterize: R (rgdal and raster packages, through Rserve) or
+native Python (which only uses R to save the raster file, and not at all for
+the tiled geoTIFF formats).
+""",
+                  "default" : "R",
+                  "choices" : [ "R","Python" ],
+                  "required" : False,
+                  "label" : "Rasterization Engine",
+                  "type" : "string",
+                  "name" : "rasterengine"
+              },
               {
                   "description" : "Number of X (East-West) cells to construct",
                   "default" : 300,
@@ -454,6 +584,20 @@ Parameters that control how rasterization will be performed.
                   "type" : "boolean",
                   "name" : "imageraster"
               },
+              {
+                  "description" : """
+The engine used to make the images: R (plotting through Rserve) or native
+Python, which draws PNG images (and JPEG images, if the Python Imaging Library
+is installed) of the input vector and of geoTIFF rasters, reduced to the size
+of the image as the raster is read.  Other images are still made by R.
+""",
+                  "default" : "R",
+                  "choices" : [ "R","Python" ],
+                  "required" : False,
+                  "label" : "Imaging Engine",
+                  "type" : "string",
+                  "name" : "imageengine"
+              },
             ],
         }
     ], 
@@ -503,13 +647,14 @@ The boolean parameters below will control what is returned.
             "description":"""
 Return a raw raster file.  The tool will return either the raster resulting from rasterization,
 or if rasterization was not attempted, then a pre-constructed geographic raster.  If you choose
-'None', then no raster will be returned, even if rasterization was attempted.
+'None', then no raster will be returned, even if rasterization was attempted.  The tiled geoTIFF
+formats are compressed (DEFLATE is smaller and faster; LZW is more widely readable).
 """,
             "default":"geoTIFF",
             "required":True,
             "label":"Return Raster",
             "type":"string",
-            "choices":["geoTIFF","Erdas Imagine Images (.img)","RData","None"],
+            "choices":["geoTIFF","geoTIFF (tiled, DEFLATE)","geoTIFF (tiled, LZW)","Erdas Imagine Images (.img)","RData","None"],
             "name":"return_raster",
           },
           {
@@ -524,6 +669,19 @@ If you choose to return a raster, use this setting to change the default base na
           },
           {
             "description":"""
+Store reduced-resolution overviews (1/2, 1/4, 1/8 ... of the size) in the returned raster, so that it can be
+displayed quickly without reading every cell, and also return a small thumbnail image of it.  Overviews are only
+made when the Python engine rasterizes into the tiled DEFLATE geoTIFF format; the thumbnail is made for any geoTIFF
+except the LZW one.
+""",
+            "default":0,
+            "required":False,
+            "label":"Overviews and Thumbnail",
+            "type":"boolean",
+            "name":"raster_overviews",
+          },
+          {
+            "description":"""
 Mirror (return) the input vector file used for rasterization as a geoJSON file.  If no rasterization input file
 was provided, return a pre-determined sample geographic vector file (the same that will be used if rasterization
 is requested but no input is provided).
@@ -560,24 +718,52 @@ will be generated in the same format.
           },
         ],
       },
+      {
+        "type":"ConfigurationPage",
+        "name":"status_output",
+        "namespace":"status_output",
+        "label":"Status Updates",
+        "description":"""
+While a job runs, the tool reports its progress to the NMTK server as status updates.
+""",
+        "elements":[
+          {
+            "description":"""
+The least number of seconds between status updates (messages in between are combined into the next update).
+Leave this empty for the tool's default, which sends each burst of messages as it happens.
+""",
+            "required":False,
+            "label":"Minimum Seconds Between Updates",
+            "type":"numeric",
+            "name":"status_interval"
+          },
+        ],
+      },
     ],
 }
 
-# Here's a simple function that you can use to dump the tool
-# configuration file into a JSON file in the templates folder.
-# Run this file as a standalone python script.
+# The staged subtool takes exactly the same parameters; only its name and
+# description differ
+staged_config = dict(tool_config)
+staged_config["info"] = dict(tool_config["info"],
+                             name = "Tool Configurator (staged)",
+                             text = """
+<p>This is the same tool as the Configurator, but each stage of a job (the
+computation, the rasterization, the images and publishing the results) is run
+as a separate task, which the tool server can hand to a different worker, so
+the demanding stages can be given workers of their own.</p>
+""" + tool_config["info"]["text"])
+
+# Run this file as a standalone python script to build the tool
+# configuration files (JSON) in the templates folder, as a build step.
 # Note that if you define the function generateToolConfiguration,
 # then that function will be called to deliver the tool configuration
 # to the NMTK, and the file-based configuration will not be used.
+if "generateToolConfiguration" not in globals():
+    refreshTemplates()
+
 if __name__ == "__main__":
-    import json
-    if not tools:
-        tools = ["tool_config"]
-    for tool_name in tools:
-        print "Configurating tool %s"%(tool_name,)
-        tool_data = eval(tool_name)
-        js = json.dumps(tool_data,indent=2, separators=(',',':'))
-        print js
-#        f = file("templates/Configurator/%s.json"%(tool_name,),"w")
-#        f.write(js)
-#        f.close()
+    for tool_name, path, text, rewritten in refreshTemplates():
+        print "Configurating tool %s: %s (%d bytes, SHA-1 %s, %s)"%(tool_name, path, len(text),
+                                                                   hashlib.sha1(text).hexdigest(),
+                                                                   "rewritten" if rewritten else "unchanged")
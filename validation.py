@@ -0,0 +1,149 @@
+# Checks the parameters of a job against the tool configuration.
+#
+# The parameter elements of the "input" and "output" sections of the tool
+# configuration (see tool_configs.py) are compiled, once per worker, into a
+# table of checks for each ConfigurationPage namespace: the type of each
+# element, its choices, whether it is required, and its default.  A job's
+# configuration is then checked and normalised in one pass, before the job
+# opens any file or R connection:
+#
+#   parameters = validation.validatorFor(subtool_name).validate(tool_config)
+#   parameters["computation_params"]["raisetopower"]    # 2, if not given
+#
+# Every element of those namespaces is present in the result (given, or its
+# default), converted to its type: numbers to int (if whole) or float,
+# booleans to 1 or 0, and strings to unicode.  A job with any value that can't
+# be converted, isn't one of the choices, or is required but missing (with no
+# default) is rejected with a ParameterError listing all of its problems.
+# The elements of File namespaces are fields of the input files, which the
+# NMTK job helper resolves, so they aren't checked here.
+
+import math
+import threading
+
+from . import tool_configs
+
+class ParameterError(ValueError):
+    '''
+    The parameters of a job don't match the tool configuration; problems
+    lists what is wrong with them
+    '''
+    def __init__(self, problems):
+        ValueError.__init__(self, "Invalid job parameters: " + "; ".join(problems))
+        self.problems = problems
+
+def toNumber(value):
+    if isinstance(value, basestring):
+        try:
+            value = float(value) if any(c in value for c in ".eEnN") else int(value)
+        except ValueError:
+            raise ValueError("not a number")
+    elif isinstance(value, bool) or not isinstance(value, (int, long, float)):
+        raise ValueError("not a number")
+    if isinstance(value, float):
+        if math.isnan(value) or math.isinf(value):
+            raise ValueError("not a finite number")
+        if value == int(value):
+            value = int(value)
+    return value
+
+def toBoolean(value):
+    if isinstance(value, basestring):
+        value = value.strip().lower()
+        if value in ("1", "true", "yes"):
+            return 1
+        if value in ("0", "false", "no", ""):
+            return 0
+    elif isinstance(value, (bool, int, long, float)) and value in (0, 1):
+        return int(value)
+    raise ValueError("not a boolean (1 or 0)")
+
+def toString(value):
+    if isinstance(value, basestring):
+        return unicode(value)
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        return unicode(value)
+    raise ValueError("not a string")
+
+# Converters for the element types of the tool configuration (each raises
+# ValueError for a value that isn't of its type)
+Converters = {
+    "number" :  toNumber,
+    "numeric" : toNumber,
+    "boolean" : toBoolean,
+    "string" :  toString,
+    }
+
+class Validator(object):
+    '''
+    Checks job configurations against the parameter elements of a tool
+    configuration (a tool_config dictionary, as in tool_configs.py)
+    '''
+    def __init__(self, config):
+        # namespace -> [ (name, converter, choices, required, default) ]
+        self.namespaces = {}
+        for section in config.get("input", []) + config.get("output", []):
+            if section.get("type") != "ConfigurationPage":
+                continue
+            checks = self.namespaces.setdefault(section["namespace"], [])
+            for element in section.get("elements", []):
+                convert = Converters.get(element.get("type"), lambda value: value)
+                choices = element.get("choices")
+                if choices is not None:
+                    choices = frozenset(convert(choice) for choice in choices)
+                default = element.get("default")
+                if default is not None:
+                    default = convert(default)
+                checks.append((element["name"], convert, choices, bool(element.get("required")), default))
+
+    def validate(self, job_config):
+        '''
+        Check and normalise a job configuration (a dictionary of namespace ->
+        dictionary of element name -> value, where each value may also be
+        given as { "type" : ..., "value" : value } as in the sample job),
+        returning a dictionary of namespace -> element name -> value for the
+        ConfigurationPage namespaces, or raising ParameterError
+        '''
+        job_config = job_config or {}
+        parameters = {}
+        problems = []
+        for namespace, checks in self.namespaces.iteritems():
+            given = job_config.get(namespace) or {}
+            values = parameters[namespace] = {}
+            for name, convert, choices, required, default in checks:
+                value = raw = given.get(name)
+                if isinstance(value, dict):
+                    value = raw = value.get("value")
+                if value is None:
+                    if default is None:
+                        if required:
+                            problems.append("%s.%s is required"%(namespace, name))
+                        continue
+                    value = default
+                else:
+                    try:
+                        value = convert(value)
+                    except (TypeError, ValueError) as e:
+                        problems.append("%s.%s: %r is %s"%(namespace, name, raw, e))
+                        continue
+                if choices is not None and value not in choices:
+                    problems.append("%s.%s: %r is not one of %s"%(namespace, name, raw,
+                                                                  ", ".join(sorted(map(unicode, choices)))))
+                    continue
+                values[name] = value
+        if problems:
+            raise ParameterError(sorted(problems))
+        return parameters
+
+_validators = {}        # sub_tool name (or None) -> Validator
+_validators_lock = threading.Lock()
+
+def validatorFor(sub_tool=None):
+    '''
+    The Validator for the configuration of the tool (or sub_tool), compiled
+    on first use
+    '''
+    with _validators_lock:
+        if sub_tool not in _validators:
+            _validators[sub_tool] = Validator(tool_configs.generateToolConfiguration(None, sub_tool))
+        return _validators[sub_tool]